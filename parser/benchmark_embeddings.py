@@ -0,0 +1,193 @@
+import argparse
+import contextlib
+import glob
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+# Compare the refiner's embedding backends on the example_pdf/ corpus: cold start (imports
+# and model load, measured in a fresh process) and throughput on name-like strings.
+
+# Get project root directory
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Configuration parameters
+backends = ['torch', 'onnx']
+name_pattern = re.compile(r"\b[A-Z][a-z]+(?: [A-Z][a-z]+){0,2}\b")  # Capitalized words as stand-ins for character names
+
+
+# Collect unique name-like strings from every PDF and text file in the corpus
+def collect_names(corpus_dir, limit):
+    import pdf_to_text
+
+    names = {}
+    for path in sorted(glob.glob(os.path.join(corpus_dir, '*'))):
+        if path.endswith('.pdf'):
+            texts = (entry['text'] for entry in pdf_to_text.iter_pages(path, os.cpu_count() or 1))
+        elif path.endswith('.txt'):
+            with open(path, 'r') as infile:
+                texts = [infile.read()]
+        else:
+            continue
+        for text in texts:
+            for match in name_pattern.finditer(text):
+                names[match.group()] = None
+    return list(names)[:limit]
+
+
+# Pairs of names the refiner would consider similar
+def similar_pair_set(vectors):
+    import results_refiner
+
+    similar = results_refiner.find_similar_pairs(vectors, results_refiner.similarity_threshold)
+    return {(i, j) for i, pairs in similar.items() for j, _ in pairs}
+
+
+# Groups of more than one name the refiner would form from the given vectors
+def name_groups(names, vectors):
+    import results_refiner
+
+    characters = {str(i): {"name": name} for i, name in enumerate(names)}
+    get_name_vectors = results_refiner.get_name_vectors
+    results_refiner.get_name_vectors = lambda _: vectors
+    try:
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            groups = results_refiner.group_similar_characters(characters)
+    finally:
+        results_refiner.get_name_vectors = get_name_vectors
+    return {frozenset(names[int(i)] for i in group) for group in groups if len(group) > 1}
+
+
+# Time one backend in this process and save its embeddings. Prints the timings as JSON.
+def run_worker(backend, names_path, vectors_path, repeats):
+    start = time.perf_counter()
+    import numpy as np
+    import results_refiner
+
+    results_refiner.embedding_backend = backend
+    model = results_refiner.get_model()
+    loaded = time.perf_counter()
+    with open(names_path, 'r') as infile:
+        names = json.load(infile)
+    model.encode(names[:1])
+    first = time.perf_counter()
+
+    durations = []
+    for _ in range(repeats):
+        encode_start = time.perf_counter()
+        vectors = np.asarray(model.encode(names, batch_size=256), dtype=np.float32)
+        durations.append(time.perf_counter() - encode_start)
+    np.save(vectors_path, vectors)
+
+    print(json.dumps({
+        "load_seconds": loaded - start,
+        "cold_start_seconds": first - start,
+        "encode_seconds": min(durations),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the embedding backends used by results_refiner.py.")
+    parser.add_argument('--corpus', default=os.path.join(PROJECT_ROOT, 'example_pdf'),
+                        help="Directory of PDFs and text files to take names from.")
+    parser.add_argument('--limit', type=int, default=2000, help="Maximum number of names to embed.")
+    parser.add_argument('--repeats', type=int, default=3, help="Encoding passes per backend; the fastest is reported.")
+    parser.add_argument('--output', help="Also write the results as JSON to this file, to keep with the change they measure.")
+    parser.add_argument('--worker', nargs=3, metavar=('BACKEND', 'NAMES', 'VECTORS'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(*args.worker, args.repeats)
+        return
+
+    import numpy as np
+    import results_refiner
+
+    names = collect_names(args.corpus, args.limit)
+    print(f"Embedding {len(names)} names from '{args.corpus}'.")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        names_path = os.path.join(work_dir, 'names.json')
+        with open(names_path, 'w') as outfile:
+            json.dump(names, outfile)
+
+        for backend in backends:
+            vectors_path = os.path.join(work_dir, f'{backend}.npy')
+            # A fresh interpreter per backend, so cold start includes every import
+            process = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--repeats', str(args.repeats),
+                 '--worker', backend, names_path, vectors_path],
+                capture_output=True, text=True,
+            )
+            if process.returncode != 0:
+                print(f"Backend '{backend}' failed:\n{process.stderr.strip()}")
+                continue
+            results[backend] = json.loads(process.stdout.strip().splitlines()[-1])
+            results[backend]["vectors"] = np.load(vectors_path)
+
+    if not results:
+        sys.exit(1)
+
+    report = {"corpus": args.corpus, "names": len(names), "repeats": args.repeats, "backends": {}}
+
+    print(f"{'backend':<8} {'load (s)':>9} {'cold start (s)':>15} {'encode (s)':>11} {'names/s':>9}")
+    for backend, result in results.items():
+        rate = len(names) / result["encode_seconds"] if result["encode_seconds"] else float('inf')
+        print(f"{backend:<8} {result['load_seconds']:>9.2f} {result['cold_start_seconds']:>15.2f} "
+              f"{result['encode_seconds']:>11.3f} {rate:>9.0f}")
+        report["backends"][backend] = {
+            "load_seconds": result["load_seconds"],
+            "cold_start_seconds": result["cold_start_seconds"],
+            "encode_seconds": result["encode_seconds"],
+            "names_per_second": rate,
+        }
+
+    # How closely the other backends match the current one, and whether the grouping would change
+    agree = True
+    if 'torch' in results:
+        reference = results_refiner.normalize_vectors(results['torch']["vectors"])
+        reference_pairs = similar_pair_set(reference)
+        for backend, result in results.items():
+            if backend == 'torch':
+                continue
+            vectors = results_refiner.normalize_vectors(result["vectors"])
+            cosine = (vectors * reference).sum(axis=1)
+            pairs = similar_pair_set(vectors)
+            groups = name_groups(names, vectors)
+            reference_groups = name_groups(names, reference)
+            differing = sorted(sorted(group) for group in groups ^ reference_groups)
+            agree = agree and not differing
+            print(f"{backend}: cosine to torch min {cosine.min():.4f}, mean {cosine.mean():.4f}; "
+                  f"similar pairs {len(pairs)} vs {len(reference_pairs)} with torch, "
+                  f"{len(pairs & reference_pairs)} shared.")
+            print(f"{backend}: {len(groups)} name groups vs {len(reference_groups)} with torch, "
+                  f"{len(differing)} differing{': ' + str(differing) if differing else ''}.")
+            report["backends"][backend].update({
+                "cosine_to_torch_min": float(cosine.min()),
+                "cosine_to_torch_mean": float(cosine.mean()),
+                "similar_pairs": len(pairs),
+                "similar_pairs_torch": len(reference_pairs),
+                "similar_pairs_shared": len(pairs & reference_pairs),
+                "groups": len(groups),
+                "groups_torch": len(reference_groups),
+                "groups_differing": differing,
+            })
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=4)
+        print(f"Results saved to '{args.output}'.")
+
+    # A non-zero exit marks a backend that would change the refiner's character grouping,
+    # or a backend that could not be run
+    if not agree or len(results) < len(backends):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
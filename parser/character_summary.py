@@ -1,73 +1,121 @@
+import asyncio
 import json
-from openai import OpenAI
-from dotenv import load_dotenv
 import os
-import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import llm_client
+import workspace
 
 # Get project root directory
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-load_dotenv()
+# Configuration parameters
+model_name = "deepseek-chat"  # Model used for every request in this stage
+summary_mode = os.getenv("SUMMARY_MODE", "auto")  # 'single' prompt, 'tree' of section summaries, or 'auto' (single while it fits)
+max_prompt_tokens = 8000  # Largest single prompt 'auto' sends before summarizing section by section
+section_tokens = 6000  # Excerpt tokens per section summary request
 
-client = OpenAI(
-    api_key=os.getenv("API_KEY"),
-    base_url="https://api.deepseek.com"
-)
 
-# Load filtered_results.json
-print("Loading filtered_results.json...")
+# Helper function to estimate the tokens of a text, as llm_client does
+def estimate_tokens(text):
+    return len(text) // 4
 
-temp_dir = os.path.join(PROJECT_ROOT, 'temp')
-os.makedirs(temp_dir, exist_ok=True)
-with open(os.path.join(temp_dir, 'filtered_results.json'), 'r') as infile:
-    filtered_results = json.load(infile)
-print("filtered_results.json loaded successfully.")
 
-# Extract characters and contexts
-characters = {k:v for k,v in filtered_results.get("characters", {}).items() if v["name"].lower() != "narrator"}
-contexts = filtered_results.get("contexts", {})
-print(f"Found {len(characters)} characters and {len(contexts)} contexts.")
-
-# Function to generate a character summary using Deepseek
-def generate_character_summary(character_name, context_texts):
+# Helper function to build the prompt for the 1 sentence summary of a character
+def character_prompt(character_name, context_texts):
     combined_text = "\n".join(context_texts)
-    prompt = (
+    return (
         f"Below are excerpts from a story that mention the character '{character_name}'. "
         f"Write a short 1 sentence summary of the character based on these excerpts.\n\n"
         f"Excerpts:\n{combined_text}\n\n"
         f"Character Summary:"
     )
 
-    retries = 3
-    for attempt in range(retries):
-        try:
-            # Send request to Deepseek API
-            print(f"Generating summary for '{character_name}' (attempt {attempt + 1}/{retries})...")
-            completion = client.chat.completions.create(
-                model="deepseek-chat",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.3,  # Lower temperature for more focused responses
-                max_completion_tokens=1024,
-                top_p=0.9,  # Slightly lower top_p to reduce randomness
-                stream=False,
-                stop=None,
-            )
-
-            # Extract the generated text from the response
-            generated_text = completion.choices[0].message.content
-            print(f"Summary generated for '{character_name}'.")
-            return generated_text.strip()
-        except Exception as err:
-            print(f"An error occurred on attempt {attempt + 1}/{retries} for character '{character_name}': {err}")
-            if attempt < retries - 1:
-                time.sleep(2)  # Wait for 2 seconds before retrying
-            else:
-                print(f"Failed to generate summary for character '{character_name}' after {retries} attempts.")
-                return None
+
+# Helper function to build the prompt summarizing one section: consecutive excerpts, or
+# consecutive section summaries when reducing
+def section_prompt(character_name, texts, reducing=False):
+    combined_text = "\n".join(texts)
+    source = "summaries of consecutive parts of a story, in story order, that describe" if reducing else \
+        "consecutive excerpts from a story, in story order, that mention"
+    return (
+        f"Below are {source} the character '{character_name}'. "
+        f"Summarize what they reveal about the character in a short paragraph of at most 5 sentences, "
+        f"keeping the key events, relationships and changes of the character.\n\n"
+        f"{'Summaries' if reducing else 'Excerpts'}:\n{combined_text}\n\n"
+        f"Section Summary:"
+    )
+
+
+# Helper function to split texts into consecutive sections of about section_tokens each. Texts
+# added at the end only change the last section, so earlier sections keep their summaries.
+def split_sections(texts):
+    sections = []
+    size = 0
+    for text in texts:
+        tokens = estimate_tokens(text) + 1
+        if not sections or size + tokens > section_tokens:
+            sections.append([])
+            size = 0
+        sections[-1].append(text)
+        size += tokens
+    return sections
+
+
+# Function to generate a character summary using Deepseek
+async def generate_character_summary(character_name, context_texts):
+    prompt = character_prompt(character_name, context_texts)
+    if summary_mode == 'tree' or summary_mode == 'auto' and estimate_tokens(prompt) > max_prompt_tokens:
+        return await generate_tree_summary(character_name, context_texts)
+    return await request_summary(character_name, prompt)
+
+
+# Summarize excerpts too long for one request: each section is summarized on its own, and
+# summaries are summarized the same way until they fit in one character prompt. Unchanged
+# sections have unchanged prompts, so after text is added their summaries come from the
+# response cache and only the changed sections are asked for.
+async def generate_tree_summary(character_name, context_texts):
+    texts = context_texts
+    reducing = False
+    while True:
+        sections = split_sections(texts)
+        print(f"Summarizing {len(texts)} {'summaries' if reducing else 'excerpts'} of '{character_name}' in {len(sections)} sections...")
+        texts = await asyncio.gather(*[
+            request_summary(character_name, section_prompt(character_name, section, reducing))
+            for section in sections
+        ])
+        if any(text is None for text in texts):
+            return None
+        # A single section's summary is as short as another round would make it
+        if len(sections) == 1 or estimate_tokens(character_prompt(character_name, texts)) <= max_prompt_tokens:
+            break
+        reducing = True
+    return await request_summary(character_name, character_prompt(character_name, texts))
+
+
+# Ask for a summary. Returns None if the request failed.
+async def request_summary(character_name, prompt):
+    try:
+        # Send request to Deepseek API (llm_client retries throttling and server errors)
+        print(f"Generating summary for '{character_name}'...")
+        # Summaries of characters with unchanged excerpts are reused from the response cache
+        generated_text = await llm_client.chat(dict(
+            model=model_name,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.3,  # Lower temperature for more focused responses
+            max_completion_tokens=1024,
+            top_p=0.9,  # Slightly lower top_p to reduce randomness
+            stream=False,
+            stop=None,
+        ), allow_sampled=True)
+        print(f"Summary generated for '{character_name}'.")
+        return generated_text.strip()
+    except Exception as err:
+        print(f"Failed to generate summary for character '{character_name}': {err}")
+        llm_client.record_failure()
+        return None
 
 # Function to process a single character
-def process_character(character_id, character_data):
+async def process_character(character_id, character_data, contexts):
     context_ids = character_data.get("contexts", [])
     context_texts = []
 
@@ -78,7 +126,7 @@ def process_character(character_id, character_data):
 
     # Generate a summary for the character
     if context_texts:
-        summary = generate_character_summary(character_data["name"], context_texts)
+        summary = await generate_character_summary(character_data["name"], context_texts)
         if summary:
             character_data["summary"] = summary
         else:
@@ -88,29 +136,52 @@ def process_character(character_id, character_data):
 
     return character_id, character_data
 
-# Process characters in parallel with a maximum of 10 threads
-print("Processing characters...")
-with ThreadPoolExecutor(max_workers=10) as executor:
-    # Submit tasks for each character
-    future_to_character = {
-        executor.submit(process_character, character_id, character_data): character_id
+
+# Summarize every character and return the final story structure
+def summarize_characters(filtered_results):
+    # Extract characters and contexts
+    characters = {k:v for k,v in filtered_results.get("characters", {}).items() if v["name"].lower() != "narrator"}
+    contexts = filtered_results.get("contexts", {})
+    print(f"Found {len(characters)} characters and {len(contexts)} contexts.")
+
+    # Process characters concurrently; llm_client adapts the concurrency to the provider's limits
+    print("Processing characters...")
+    results = llm_client.run_all([
+        process_character(character_id, character_data, contexts)
         for character_id, character_data in characters.items()
-    }
+    ])
+    for character_id, character_data in results:
+        print(f"Finished processing character: {character_data['name']}.")
+
+    return {"characters": characters, "contexts": contexts}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize every character in filtered_results.json.")
+    workspace.add_argument(parser)
+    parser.add_argument('--output', default=os.path.join(PROJECT_ROOT, 'out', 'output.json'),
+                        help="Where to write the final story JSON (default: out/output.json).")
+    args = parser.parse_args()
+
+    # Load filtered_results.json
+    print("Loading filtered_results.json...")
+
+    temp_dir = args.workspace
+    os.makedirs(temp_dir, exist_ok=True)
+    with open(os.path.join(temp_dir, 'filtered_results.json'), 'r') as infile:
+        filtered_results = json.load(infile)
+    print("filtered_results.json loaded successfully.")
+
+    output = summarize_characters(filtered_results)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
 
-    # Process results as they are completed
-    for future in as_completed(future_to_character):
-        character_id = future_to_character[future]
-        try:
-            character_id, character_data = future.result()
-            print(f"Finished processing character: {character_data['name']}.")
-        except Exception as err:
-            print(f"An error occurred while processing character {character_id}: {err}")
+    # Save the updated characters data to a new JSON file
+    with open(args.output, 'w') as outfile:
+        json.dump(output, outfile, indent=4)
 
-out_dir = os.path.join(PROJECT_ROOT, 'out')
-os.makedirs(temp_dir, exist_ok=True)
+    print(f"Character summaries saved to '{args.output}'.")
 
-# Save the updated characters data to a new JSON file
-with open(os.path.join(out_dir, 'output.json'), 'w') as outfile:
-    json.dump({"characters": characters, "contexts": contexts}, outfile, indent=4)
 
-print("Character summaries saved to 'output.json'.")
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+import json
+import os
+import argparse
+from bisect import bisect_right
+import llm_client
+from llm_cache import discard_cached_completion
+
+# Get project root directory
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Configuration parameters
+model_name = "deepseek-chat"  # Model used for every request in this stage
+sentiment_window_pages = 10  # Sentiments are taken from contexts ending in this many pages before the current one
+max_checkpoints = 40  # Most analyses of each kind per character; longer timelines are thinned evenly
+retries = 2  # Attempts per analysis when the response holds no JSON list
+personality_batch_tokens = 8000  # Most context tokens per personality request; later contexts update the traits found so far
+
+# The chatbot asks the same questions at chat time for stories without timelines, so both
+# build their prompts and requests here. The requests are sampled, so their answers are not
+# kept in the response cache; personality timelines are built incrementally so no prompt
+# grows with the story.
+
+
+def sentiment_prompt(character_name, texts):
+    return (
+        f"What are the main sentiments of {character_name} with the given dialogues? {texts}. "
+        f"Please put your response in list format [sentiment1, sentiment2, ...]. "
+        f"Ensure that the response is valid JSON and does not include any comments or explanations."
+    )
+
+
+def personality_prompt(character_name, texts):
+    return (
+        f"What are the most important personality traits of {character_name} with the given dialogues? {texts}. "
+        f"Please put your response in list format [trait1, trait2, ...]. "
+        f"Ensure that the response is valid JSON and does not include any comments or explanations."
+    )
+
+
+def personality_update_prompt(character_name, traits, texts):
+    return (
+        f"So far, {character_name} has shown these personality traits: {traits}. "
+        f"What are the most important personality traits of {character_name} given those traits and the following new dialogues? {texts}. "
+        f"Please put your response in list format [trait1, trait2, ...]. "
+        f"Ensure that the response is valid JSON and does not include any comments or explanations."
+    )
+
+
+def analysis_request(prompt):
+    return dict(
+        model=model_name,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=1,
+        max_completion_tokens=1024,
+        top_p=1,
+        stream=False,
+        response_format={"type": "json_object"},
+        stop=None,
+    )
+
+
+# Helper function to find the JSON list within a response. Returns None if there is none.
+def parse_list(generated_text):
+    start = generated_text.find('[')
+    end = generated_text.rfind(']')
+    if start == -1 or end <= start:
+        return None
+    try:
+        response = json.loads(generated_text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    return response if isinstance(response, list) else None
+
+
+# Ask for one analysis and return the list in the response, or None if there was none
+async def analyze(prompt):
+    request = analysis_request(prompt)
+    for attempt in range(retries):
+        try:
+            generated_text = await llm_client.chat(request)
+        except Exception as err:
+            print(f"Analysis request failed: {err}")
+            llm_client.record_failure()
+            return None
+        # A response without content is treated as unparseable
+        response = parse_list(generated_text or "")
+        if response is not None:
+            return response
+        print(f"No JSON list found in response, attempt {attempt + 1}/{retries}.")
+        # Do not keep serving a response that could not be used
+        discard_cached_completion(request)
+    llm_client.record_failure()
+    return None
+
+
+# Helper function to keep at most limit checkpoints, evenly spread and always keeping the last one
+def thin(checkpoints, limit=None):
+    limit = limit or max_checkpoints
+    if len(checkpoints) <= limit:
+        return checkpoints
+    return [checkpoints[round(i * (len(checkpoints) - 1) / (limit - 1))] for i in range(limit)]
+
+
+# Pages at which a character's context windows change, with the contexts each covers.
+# contexts is a list of (last page, context key) sorted by last page. From a checkpoint's
+# page until the next one, the chatbot would pick exactly these contexts.
+def character_checkpoints(contexts):
+    last_pages = [last_page for last_page, _ in contexts]
+    keys = [key for _, key in contexts]
+
+    # Every context ending by the page
+    personality = [(page, keys[:bisect_right(last_pages, page)]) for page in sorted(set(last_pages))]
+
+    # Contexts ending in the window before the page; windows change as contexts enter and leave
+    sentiment = []
+    for page in sorted(set(last_pages) | {last_page + sentiment_window_pages for last_page in last_pages}):
+        end = bisect_right(last_pages, page)
+        window = keys[bisect_right(last_pages, page - sentiment_window_pages, 0, end):end]
+        if not sentiment or sentiment[-1][1] != window:
+            sentiment.append((page, window))
+
+    return thin(personality), thin(sentiment)
+
+
+# Helper function to split texts into consecutive batches of about personality_batch_tokens each
+def batch_texts(texts):
+    batches = []
+    size = 0
+    for text in texts:
+        tokens = len(text) // 4
+        if not batches or size + tokens > personality_batch_tokens:
+            batches.append([])
+            size = 0
+        batches[-1].append(text)
+        size += tokens
+    return batches
+
+
+# Fill a character's personality timeline in order. Each checkpoint only sends the contexts
+# not yet covered by the traits found so far, in bounded batches, together with those traits.
+# When a request fails, its contexts are sent again at the next checkpoint, and entries stay
+# None until the traits cover every context up to them.
+async def build_personality_timeline(name, checkpoints, contexts):
+    traits = None
+    done = 0  # Contexts covered by traits
+    for entry, keys in checkpoints:
+        for texts in batch_texts([contexts[key]["text"] for key in keys[done:]]):
+            prompt = personality_prompt(name, texts) if traits is None else personality_update_prompt(name, traits, texts)
+            response = await analyze(prompt)
+            if response is None:
+                break
+            traits = response
+            done += len(texts)
+        entry["traits"] = traits if done == len(keys) else None
+
+
+# Attach a personality and a sentiment timeline to every character in place and return the
+# story. Each timeline entry holds the analysis that applies from its page to the next entry's.
+def build_timelines(story):
+    contexts = story["contexts"]
+    by_character = {}
+    for key, context in contexts.items():
+        for name in dict.fromkeys(context["characters"]):
+            by_character.setdefault(name, []).append((context["page_nums"][-1], key))
+
+    jobs = []  # (timeline entry, field, prompt)
+    personality_jobs = []  # Per character, sequential personality updates
+    for character in story["characters"].values():
+        name = character["name"]
+        personality, sentiment = character_checkpoints(sorted(by_character.get(name, []), key=lambda entry: entry[0]))
+        character["personality_timeline"] = []
+        character["sentiment_timeline"] = []
+        checkpoints = []
+        for page, keys in personality:
+            entry = {"page": page, "context_count": len(keys), "traits": None}
+            character["personality_timeline"].append(entry)
+            checkpoints.append((entry, keys))
+        personality_jobs.append(build_personality_timeline(name, checkpoints, contexts))
+        for page, keys in sentiment:
+            entry = {"page": page, "context_count": len(keys), "sentiments": [] if not keys else None}
+            character["sentiment_timeline"].append(entry)
+            if keys:
+                jobs.append((entry, "sentiments", sentiment_prompt(name, [contexts[key]["text"] for key in keys])))
+
+    # Characters and sentiment analyses run concurrently, each character's personality updates
+    # in order; llm_client adapts to the provider's limits
+    print(f"Running {len(jobs)} sentiment analyses and {len(personality_jobs)} personality timelines...")
+    results = llm_client.run_all([analyze(prompt) for _, _, prompt in jobs] + personality_jobs)
+    for (entry, field, _), result in zip(jobs, results):
+        entry[field] = result
+    print("Character timelines built.")
+    return story
+
+
+# Return the latest timeline entry at or before page, or None if the timeline starts later
+def timeline_entry(timeline, page):
+    position = bisect_right([entry["page"] for entry in timeline], page)
+    return timeline[position - 1] if position else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add personality and sentiment timelines to a story.")
+    parser.add_argument('--story', default=os.path.join(PROJECT_ROOT, 'out', 'output.json'),
+                        help="Story JSON to update in place (default: out/output.json).")
+    args = parser.parse_args()
+
+    with open(args.story, 'r') as infile:
+        story = json.load(infile)
+
+    build_timelines(story)
+
+    with open(args.story, 'w') as outfile:
+        json.dump(story, outfile, indent=4)
+    print(f"Timelines saved to '{args.story}'.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import json
+import os
+import llm_client
+from llm_cache import discard_cached_completion
+import chunker_summary
+import extract_characters
+import workspace
+
+# Get project root directory
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Configuration parameters
+model_name = "deepseek-chat"  # Model used for the fused analysis
+
+
+# Summarize a chunk and list its characters with a single request.
+# Returns the summary and the character list, which is None if it could not be parsed.
+async def analyze_chunk(chunk):
+    prompt = (
+        f"Below is a chunk of text from a document. Respond with a JSON object with two keys.\n\n"
+        f"\"summary\": a concise 1-sentence summary of the key points of the text.\n\n"
+        f"\"characters\": the names of characters mentioned in the text. Resolve pronouns or relational terms "
+        f"to determine the specific individuals they refer to (e.g., identify who 'he' or 'she' refers to, "
+        f"and clarify whose 'dad' or 'mom' is being mentioned) based on the context. Only replace 'I' with 'Narrator' "
+        f"if the text is written in the first person and the narrator is relevant to the context. "
+        f"If the text is not written in the first person, exclude the narrator from the list of characters. "
+        f"Use a JSON array of character names, such as [\"Character1\", \"Character2\"].\n\n"
+        f"Ensure the output is valid JSON without any comments or explanations, such as "
+        f"{{\"summary\": \"...\", \"characters\": [\"Character1\", \"Character2\"]}}.\n\n"
+        f"Text:\n{chunk['text']}"
+    )
+
+    request = dict(
+        model=model_name,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0.3,  # Lower temperature for more focused responses
+        max_completion_tokens=1024,
+        top_p=0.9,  # Slightly lower top_p to reduce randomness
+        stream=False,
+        response_format={"type": "json_object"},
+        stop=None,
+    )
+
+    try:
+        print(f"Analyzing chunk {chunk['chunk_num']}...")
+        # A response without content is treated as unparseable
+        generated_text = await llm_client.chat(request, allow_sampled=True) or ""
+    except Exception as err:
+        print(f"Failed to analyze chunk {chunk['chunk_num']}: {err}")
+        llm_client.record_failure()
+        return "No summary available.", None
+
+    try:
+        response = json.loads(generated_text)
+    except json.JSONDecodeError as json_err:
+        print(f"JSON decode error for chunk {chunk['chunk_num']}: {json_err}")
+        response = None
+
+    summary = response.get("summary") if isinstance(response, dict) else None
+    characters = response.get("characters") if isinstance(response, dict) else None
+    if not isinstance(summary, str) or not isinstance(characters, list):
+        print(f"Invalid response format for chunk {chunk['chunk_num']}")
+        # Do not keep serving a response that could not be used
+        discard_cached_completion(request)
+        llm_client.record_failure()
+    if not isinstance(summary, str):
+        summary = "No summary available."
+    if not isinstance(characters, list):
+        characters = None
+    return summary.strip(), characters
+
+
+# Add a summary to every chunk in place and return the characters found in each chunk,
+# in the same shapes as chunker_summary.py and extract_characters.py produce
+def analyze_chunks(chunks):
+    print("Analyzing chunks...")
+    results = llm_client.run_all([analyze_chunk(chunk) for chunk in chunks])
+
+    cumulative_characters = []
+    for chunk, (summary, characters) in zip(chunks, results):
+        chunk['summary'] = summary
+        if characters is not None:
+            cumulative_characters.append({"chunk_num": chunk['chunk_num'], "characters": characters})
+        print(f"Finished processing chunk {chunk['chunk_num']}.")
+    return chunks, cumulative_characters
+
+
+def main():
+    temp_dir = workspace.parse_workspace("Summarize every chunk of the transcript and list its characters in one request.")
+    data = chunker_summary.load_transcript(temp_dir)
+
+    chunks, cumulative_characters = analyze_chunks(chunker_summary.create_chunks(data))
+
+    # Save chunks to chunks.json
+    with open(os.path.join(temp_dir, 'chunks.json'), 'w') as outfile:
+        json.dump(chunks, outfile, indent=4)
+    print("Chunks saved to 'chunks.json'.")
+
+    # Save the cumulative characters data to a JSON file
+    with open(os.path.join(temp_dir, 'cumulative_characters.json'), 'w') as outfile:
+        json.dump(cumulative_characters, outfile, indent=4)
+    print("Cumulative characters saved to 'cumulative_characters.json'.")
+
+    extract_characters.refine_character_names(cumulative_characters)
+
+    # Save the refined characters to a JSON file
+    with open(os.path.join(temp_dir, 'characters.json'), 'w') as outfile:
+        json.dump(cumulative_characters, outfile, indent=4)
+    print("Characters saved to 'characters.json'.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# Compact in-memory chunk records shared by the pipeline stages.
+# Records keep the dict-style access (chunk['text']) the stages already use, so a
+# stage works the same on records and on chunks loaded from JSON.
+
+
+class ChunkRecord:
+    # Field order matches the chunk JSON written by the merge scripts
+    __slots__ = ('chunk_num', 'page_nums', 'text', 'summary', 'characters', 'important')
+
+    def __init__(self, **fields):
+        for name, value in fields.items():
+            self[name] = value
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def __setitem__(self, name, value):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        setattr(self, name, value)
+
+    def __contains__(self, name):
+        return name in self.__slots__ and hasattr(self, name)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default) if name in self.__slots__ else default
+
+    # Names of the fields that have been set, in JSON order
+    def keys(self):
+        return [name for name in self.__slots__ if hasattr(self, name)]
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.keys()}
+
+
+# Chunks in document order with O(1) lookup by chunk number. Holds ChunkRecords or
+# plain chunk dicts; either way fields are attached to the stored objects in place.
+class ChunkStore:
+    def __init__(self, chunks=()):
+        self.chunks = list(chunks)
+        self.index = {chunk['chunk_num']: position for position, chunk in enumerate(self.chunks)}
+
+    # Build a store of compact records from chunk dicts, e.g. loaded from chunks.json
+    @classmethod
+    def from_dicts(cls, chunks):
+        return cls(ChunkRecord(**chunk) for chunk in chunks)
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __contains__(self, chunk_num):
+        return chunk_num in self.index
+
+    # Return the chunk with the given number, or None
+    def get(self, chunk_num):
+        position = self.index.get(chunk_num)
+        return None if position is None else self.chunks[position]
+
+    # Set field on every chunk from a chunk_num -> value mapping. Chunks missing from
+    # values get default_factory(), or None without a factory.
+    def attach(self, field, values, default_factory=None):
+        for chunk in self.chunks:
+            if chunk['chunk_num'] in values:
+                chunk[field] = values[chunk['chunk_num']]
+            else:
+                chunk[field] = default_factory() if default_factory else None
+
+    def to_dicts(self):
+        return [chunk.to_dict() if isinstance(chunk, ChunkRecord) else chunk for chunk in self.chunks]
@@ -1,9 +1,11 @@
 import json
+import math
 import os
-import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from openai import OpenAI
-from dotenv import load_dotenv
+import re
+from bisect import bisect_right
+import llm_client
+from chunk_store import ChunkStore
+import workspace
 
 # Get project root directory
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -11,113 +13,208 @@ PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 # Configuration parameters
 chunk_size_words = 500  # Number of words per chunk
 overlap_size_words = 100  # Number of words overlapping between chunks
+model_name = "deepseek-chat"  # Model used for chunk summaries
+chunk_size_tokens = 700  # Target tokens per chunk for create_token_chunks
+overlap_size_tokens = 140  # Tokens of whole sentences repeated from the end of the previous chunk
+chars_per_token = 4  # Rough characters per LLM token, the same estimate llm_client uses
+
+# End of a sentence (terminator, closing quotes or brackets, whitespace) or a paragraph break
+sentence_boundary = re.compile(r'[.!?]+["\'\u201d\u2019)\]]*\s+|\n\s*\n')
+
+
+# Load the transcript written by pdf_to_text.py or txt_to_transcript.py
+def load_transcript(temp_dir):
+    # pdf_to_text.py --jsonl streams one page per line instead of writing transcript.json
+    if os.path.exists(os.path.join(temp_dir, 'transcript.jsonl')):
+        with open(os.path.join(temp_dir, 'transcript.jsonl'), 'r') as infile:
+            return [json.loads(line) for line in infile if line.strip()]
+    with open(os.path.join(temp_dir, 'transcript.json'), 'r') as infile:
+        return json.load(infile)
+
+
+# Split the transcript into overlapping chunks of words
+def create_chunks(data):
+    # Collect words and the index of the first word of every page
+    words = []
+    page_starts = []
+    page_nums = []
+    for page in data:
+        text = page['text']
+        page_words = text.split()
+        if not page_words:
+            continue
+        page_starts.append(len(words))
+        page_nums.append(page['page_num'] + 1)  # Assuming page_num starts at 0
+        words.extend(page_words)
+
+    # Create chunks of words with specified overlap
+    chunks = []
+    start_index = 0
+    total_words = len(words)
+
+    print("Creating chunks...")
+    while start_index < total_words:
+        end_index = start_index + chunk_size_words
+        if end_index > total_words:
+            end_index = total_words
+        chunk_words = words[start_index:end_index]
+        chunk_text = ' '.join(chunk_words)
+        # Pages holding the first and last word of the chunk, and every page in between
+        first_page = bisect_right(page_starts, start_index) - 1
+        last_page = bisect_right(page_starts, end_index - 1) - 1
+        chunk_page_nums = sorted(set(page_nums[first_page:last_page + 1]))
+        chunks.append({
+            'chunk_num': len(chunks) + 1,
+            'page_nums': chunk_page_nums,
+            'text': chunk_text
+        })
+        start_index += chunk_size_words - overlap_size_words
+    return chunks
+
+
+# Helper function to estimate the LLM tokens of a span of text
+def count_tokens(length):
+    return max(1, math.ceil(length / chars_per_token))
+
+
+# Yield (start, end) offsets of the sentences and paragraphs of text. Segments longer than
+# max_tokens (e.g. verse without punctuation) are split further at whitespace.
+def iter_segments(text, max_tokens):
+    start = 0
+    for match in sentence_boundary.finditer(text):
+        yield from split_long_segment(text, start, match.end(), max_tokens)
+        start = match.end()
+    if start < len(text):
+        yield from split_long_segment(text, start, len(text), max_tokens)
+
+
+def split_long_segment(text, start, end, max_tokens):
+    if count_tokens(end - start) <= max_tokens:
+        yield start, end
+        return
+    piece_start = start
+    for word in re.finditer(r'\S+', text[start:end]):
+        word_end = start + word.end()
+        if count_tokens(word_end - piece_start) > max_tokens and word.start() + start > piece_start:
+            yield piece_start, start + word.start()
+            piece_start = start + word.start()
+    yield piece_start, end
+
+
+# Split the transcript into chunks of about token_budget tokens that start and end on
+# sentence or paragraph boundaries, repeating up to overlap_tokens of whole sentences.
+# Pages are mapped through the offset of each page in the joined text, so memory is
+# linear in the number of pages and chunks rather than words.
+def create_token_chunks(data, token_budget=chunk_size_tokens, overlap_tokens=overlap_size_tokens):
+    page_starts = []
+    page_nums = []
+    parts = []
+    length = 0
+    for page in data:
+        if not page['text'].strip():
+            continue
+        page_starts.append(length)
+        page_nums.append(page['page_num'] + 1)  # Assuming page_num starts at 0
+        parts.append(page['text'])
+        length += len(page['text']) + 1
+    text = '\n'.join(parts)
+
+    chunks = []
+
+    # Helper function to turn a run of segments into a chunk
+    def add_chunk(segments):
+        start, end = segments[0][0], segments[-1][1]
+        chunk_text = ' '.join(text[start:end].split())
+        if not chunk_text:
+            return
+        first_page = bisect_right(page_starts, start) - 1
+        last_page = bisect_right(page_starts, end - 1) - 1
+        chunks.append({
+            'chunk_num': len(chunks) + 1,
+            'page_nums': sorted(set(page_nums[first_page:last_page + 1])),
+            'text': chunk_text
+        })
+
+    print("Creating chunks...")
+    current = []  # (start, end, tokens) of the segments in the chunk being built
+    current_tokens = 0
+    for start, end in iter_segments(text, token_budget):
+        tokens = count_tokens(end - start)
+        if current and current_tokens + tokens > token_budget:
+            add_chunk(current)
+            # Carry whole trailing sentences into the next chunk, always dropping at least one
+            overlap = []
+            overlap_total = 0
+            for segment in reversed(current[1:]):
+                if overlap_total + segment[2] > overlap_tokens or overlap_total + segment[2] + tokens > token_budget:
+                    break
+                overlap.insert(0, segment)
+                overlap_total += segment[2]
+            current = overlap
+            current_tokens = overlap_total
+        current.append((start, end, tokens))
+        current_tokens += tokens
+    if current:
+        add_chunk(current)
+    return chunks
 
-# Load environment variables
-load_dotenv()
-
-# Initialize OpenAI client
-client = OpenAI(
-    api_key=os.getenv("API_KEY"),
-    base_url="https://api.deepseek.com"
-)
-
-# Load data from transcript.json
-temp_dir = os.path.join(PROJECT_ROOT, 'temp')
-os.makedirs(temp_dir, exist_ok=True)
-
-with open(os.path.join(temp_dir, 'transcript.json'), 'r') as infile:
-    data = json.load(infile)
-
-# Collect words and their corresponding page numbers
-words = []
-page_nums = []
-for page in data:
-    text = page['text']
-    page_words = text.split()
-    words.extend(page_words)
-    page_num = page['page_num'] + 1  # Assuming page_num starts at 0
-    page_nums.extend([page_num] * len(page_words))
-
-# Create chunks of words with specified overlap
-chunks = []
-start_index = 0
-total_words = len(words)
-
-print("Creating chunks...")
-while start_index < total_words:
-    end_index = start_index + chunk_size_words
-    if end_index > total_words:
-        end_index = total_words
-    chunk_words = words[start_index:end_index]
-    chunk_text = ' '.join(chunk_words)
-    chunk_page_nums = sorted(list(set(page_nums[start_index:end_index])))
-    chunks.append({
-        'chunk_num': len(chunks) + 1,
-        'page_nums': chunk_page_nums,
-        'text': chunk_text
-    })
-    start_index += chunk_size_words - overlap_size_words
 
 # Function to generate a 1-sentence summary for a chunk
-def generate_chunk_summary(chunk):
+async def generate_chunk_summary(chunk):
     prompt = (
         f"Below is a chunk of text from a document. Write a concise 1-sentence summary of the key points.\n\n"
         f"Text:\n{chunk['text']}\n\n"
         f"Summary:"
     )
 
-    retries = 3
-    for attempt in range(retries):
-        try:
-            # Send request to Deepseek API
-            print(f"Generating summary for chunk {chunk['chunk_num']} (attempt {attempt + 1}/{retries})...")
-            completion = client.chat.completions.create(
-                model="deepseek-chat",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.3,  # Lower temperature for more focused responses
-                max_completion_tokens=1024,
-                top_p=0.9,  # Slightly lower top_p to reduce randomness
-                stream=False,
-                stop=None,
-            )
-
-            # Extract the generated text from the response
-            generated_text = completion.choices[0].message.content
-            print(f"Summary generated for chunk {chunk['chunk_num']}.")
-            return chunk['chunk_num'], generated_text.strip()
-        except Exception as err:
-            print(f"An error occurred on attempt {attempt + 1}/{retries} for chunk {chunk['chunk_num']}: {err}")
-            if attempt < retries - 1:
-                time.sleep(2)  # Wait for 2 seconds before retrying
-            else:
-                print(f"Failed to generate summary for chunk {chunk['chunk_num']} after {retries} attempts.")
-                return chunk['chunk_num'], "No summary available."
-
-# Process chunks in parallel with a maximum of 10 threads
-print("Generating summaries for chunks...")
-with ThreadPoolExecutor(max_workers=10) as executor:
-    # Submit tasks for each chunk
-    future_to_chunk = {
-        executor.submit(generate_chunk_summary, chunk): chunk['chunk_num']
-        for chunk in chunks
-    }
-
-    # Process results as they are completed
-    for future in as_completed(future_to_chunk):
-        chunk_num = future_to_chunk[future]
-        try:
-            chunk_num, summary = future.result()
-            # Add the summary to the corresponding chunk
-            for chunk in chunks:
-                if chunk['chunk_num'] == chunk_num:
-                    chunk['summary'] = summary
-                    break
-            print(f"Finished processing chunk {chunk_num}.")
-        except Exception as err:
-            print(f"An error occurred while processing chunk {chunk_num}: {err}")
-
-# Save chunks to chunks.json
-with open(os.path.join(temp_dir, 'chunks.json'), 'w') as outfile:
-    json.dump(chunks, outfile, indent=4)
-
-print("Chunks saved to 'chunks.json'.")
\ No newline at end of file
+    try:
+        # Send request to Deepseek API (llm_client retries throttling and server errors)
+        print(f"Generating summary for chunk {chunk['chunk_num']}...")
+        # Summaries of identical chunks are reused from the response cache when reprocessing
+        generated_text = await llm_client.chat(dict(
+            model=model_name,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.3,  # Lower temperature for more focused responses
+            max_completion_tokens=1024,
+            top_p=0.9,  # Slightly lower top_p to reduce randomness
+            stream=False,
+            stop=None,
+        ), allow_sampled=True)
+        print(f"Summary generated for chunk {chunk['chunk_num']}.")
+        return chunk['chunk_num'], generated_text.strip()
+    except Exception as err:
+        print(f"Failed to generate summary for chunk {chunk['chunk_num']}: {err}")
+        llm_client.record_failure()
+        return chunk['chunk_num'], "No summary available."
+
+
+# Add a summary to every chunk in place
+def summarize_chunks(chunks):
+    # Process chunks concurrently; llm_client adapts the concurrency to the provider's limits
+    print("Generating summaries for chunks...")
+    results = llm_client.run_all([generate_chunk_summary(chunk) for chunk in chunks])
+
+    store = ChunkStore(chunks)
+    for chunk_num, summary in results:
+        # Add the summary to the corresponding chunk
+        store.get(chunk_num)['summary'] = summary
+        print(f"Finished processing chunk {chunk_num}.")
+    return chunks
+
+
+def main():
+    # Load data from the transcript
+    temp_dir = workspace.parse_workspace("Split the transcript into chunks and summarize each one.")
+    data = load_transcript(temp_dir)
+
+    chunks = summarize_chunks(create_chunks(data))
+
+    # Save chunks to chunks.json
+    with open(os.path.join(temp_dir, 'chunks.json'), 'w') as outfile:
+        json.dump(chunks, outfile, indent=4)
+
+    print("Chunks saved to 'chunks.json'.")
+
+
+if __name__ == '__main__':
+    main()
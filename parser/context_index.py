@@ -0,0 +1,106 @@
+import json
+import os
+import tempfile
+import numpy as np
+import results_refiner
+
+# Vector index of a story's contexts, built once when the story is written and stored next
+# to it (out/<story>.index/) as a float32 matrix that is memory-mapped when opened. The
+# chatbot uses it to pick the contexts most relevant to a question instead of sending all of them.
+
+# Configuration parameters
+index_suffix = '.index'  # out/<story>.json -> out/<story>.index/
+chars_per_token = 4  # Rough characters per token, as in llm_client.estimate_tokens
+
+
+# Directory of the index for the story file at story_path
+def index_dir(story_path):
+    return os.path.splitext(story_path)[0] + index_suffix
+
+
+# Helper function to get the text embedded for a context; the summary comes first so it
+# survives the embedding model's truncation of long texts
+def context_document(context):
+    return f"{context.get('summary') or ''}\n{context['text']}"
+
+
+# Helper function to embed texts into unit-length vectors with the refiner's model
+def embed(texts):
+    return results_refiner.normalize_vectors(results_refiner.get_model().encode(texts, batch_size=64))
+
+
+# Embed a query into a unit-length vector
+def embed_query(text):
+    return embed([text])[0]
+
+
+# Embed every context of the story and write the index to directory
+def build_context_index(story, directory):
+    keys = list(story["contexts"])
+    print(f"Embedding {len(keys)} contexts...")
+    vectors = embed([context_document(story["contexts"][key]) for key in keys]) if keys else np.zeros((0, 0), np.float32)
+
+    os.makedirs(directory, exist_ok=True)
+    # The vectors are replaced before the key list, so a key list always describes complete vectors.
+    # Temporary files get unique names, so concurrent builds never write into each other's files.
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as outfile:
+        outfile.write(vectors.astype(np.float32).tobytes())
+    os.replace(tmp_path, os.path.join(directory, 'vectors.f32'))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as outfile:
+        json.dump({"model": results_refiner.embedding_model_key(), "dim": int(vectors.shape[1]), "keys": keys}, outfile)
+    os.replace(tmp_path, os.path.join(directory, 'keys.json'))
+    print(f"Context index saved to '{directory}'.")
+    return ContextIndex(directory)
+
+
+# A story's context vectors, memory-mapped, with the context key of every row
+class ContextIndex:
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'keys.json'), 'r') as infile:
+            meta = json.load(infile)
+        self.model = meta["model"]
+        self.keys = meta["keys"]
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+        if self.keys:
+            self.vectors = np.memmap(os.path.join(directory, 'vectors.f32'), dtype=np.float32, mode='r',
+                                     shape=(len(self.keys), meta["dim"]))
+        else:
+            self.vectors = np.zeros((0, meta["dim"]), dtype=np.float32)
+
+    # Return up to k of the given context keys, most similar to query_vector first, with their scores
+    def search(self, query_vector, keys, k):
+        keys = [key for key in keys if key in self.rows]
+        if not keys or k <= 0:
+            return []
+        scores = self.vectors[[self.rows[key] for key in keys]] @ query_vector
+        top = np.argpartition(-scores, k - 1)[:k] if k < len(keys) else np.arange(len(keys))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(keys[i], float(scores[i])) for i in top]
+
+
+# Open the index of a story, building it first if it is missing or does not match the
+# story's contexts or the current embedding model
+def open_context_index(story, directory):
+    try:
+        index = ContextIndex(directory)
+        if index.model == results_refiner.embedding_model_key() and index.keys == list(story["contexts"]):
+            return index
+    except (FileNotFoundError, json.JSONDecodeError, KeyError, ValueError):
+        pass
+    return build_context_index(story, directory)
+
+
+# Pick the keys, from candidate keys, of the contexts most relevant to query: the top k by
+# similarity that fit in token_budget together, returned in the order of candidates
+def select_contexts(index, story, query, candidates, k, token_budget):
+    chosen = set()
+    used = 0
+    for key, _ in index.search(embed_query(query), candidates, k):
+        tokens = len(story["contexts"][key]["text"]) // chars_per_token
+        if used + tokens > token_budget:
+            continue
+        chosen.add(key)
+        used += tokens
+    return [key for key in candidates if key in chosen]
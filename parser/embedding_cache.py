@@ -0,0 +1,104 @@
+import fcntl
+import json
+import os
+import re
+import unicodedata
+import numpy as np
+
+# Get project root directory
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Configuration parameters
+cache_dir = os.path.join(PROJECT_ROOT, 'cache', 'embeddings')  # One subdirectory per embedding model
+cache_enabled = os.getenv("EMBEDDING_CACHE_DISABLED", "") == ""
+
+
+# Helper function to normalize a string before it is embedded and used as a key
+def normalize_text(text):
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+# Embeddings of short strings (e.g. character names) for one model, stored on disk as a
+# float32 matrix that is memory-mapped, plus an index of the strings in row order.
+# Rows are only ever appended, so runs on other books reuse the names they share.
+class EmbeddingCache:
+    def __init__(self, model_name, directory=cache_dir):
+        self.model_name = model_name
+        self.directory = os.path.join(directory, re.sub(r'[^A-Za-z0-9._-]', '_', model_name))
+        os.makedirs(self.directory, exist_ok=True)
+        self.vectors_path = os.path.join(self.directory, 'vectors.f32')
+        self.index_path = os.path.join(self.directory, 'index.jsonl')
+        self.meta_path = os.path.join(self.directory, 'meta.json')
+        self._load()
+
+    # Helper function to (re)open the matrix and index as currently on disk
+    def _load(self):
+        self.dim = None
+        self.index = {}
+        self.vectors = None
+        try:
+            with open(self.meta_path, 'r') as infile:
+                self.dim = json.load(infile)["dim"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return
+
+        texts = []
+        try:
+            with open(self.index_path, 'r') as infile:
+                for line in infile:
+                    try:
+                        texts.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break  # Stop at a line left incomplete by an interrupted write
+        except FileNotFoundError:
+            pass
+
+        size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+        # Vectors are written before their index lines, so only rows present in both are used
+        rows = min(len(texts), size // (4 * self.dim))
+        if rows:
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(rows, self.dim))
+        self.index = {text: row for row, text in enumerate(texts[:rows])}
+
+    # Return a float32 matrix with one row per text. Texts not cached yet are embedded with
+    # encode(list_of_texts) and appended to the cache.
+    def encode(self, texts, encode):
+        keys = [normalize_text(text) for text in texts]
+        missing = [key for key in dict.fromkeys(keys) if key not in self.index]
+        if missing:
+            self._append(missing, encode)
+        if not keys:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        rows = np.fromiter((self.index[key] for key in keys), dtype=np.int64, count=len(keys))
+        return np.asarray(self.vectors[rows])
+
+    # Helper function to embed texts and append them, holding a lock so concurrent runs do not interleave rows
+    def _append(self, texts, encode):
+        with open(os.path.join(self.directory, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._load()  # Another process may have added some of the texts meanwhile
+            texts = [text for text in texts if text not in self.index]
+            if not texts:
+                return
+
+            vectors = np.asarray(encode(texts), dtype=np.float32)
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self.meta_path, 'w') as outfile:
+                    json.dump({"model": self.model_name, "dim": self.dim}, outfile)
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Embedding size {vectors.shape[1]} does not match the cached size {self.dim}.")
+
+            rows = len(self.index)
+            with open(self.vectors_path, 'r+b' if os.path.exists(self.vectors_path) else 'wb') as outfile:
+                # Drop any rows without an index line before appending
+                outfile.truncate(rows * 4 * self.dim)
+                outfile.seek(0, os.SEEK_END)
+                outfile.write(vectors.tobytes())
+            with open(self.index_path, 'r+' if os.path.exists(self.index_path) else 'w') as outfile:
+                for _ in range(rows):
+                    outfile.readline()
+                outfile.truncate(outfile.tell())
+                for text in texts:
+                    outfile.write(json.dumps(text) + '\n')
+            self._load()
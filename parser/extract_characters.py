@@ -1,124 +1,210 @@
 import json
-from openai import OpenAI
-from dotenv import load_dotenv
 import os
-import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import llm_client
+from llm_cache import discard_cached_completion
+import workspace
 
 # Get project root directory
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-temp_dir = os.path.join(PROJECT_ROOT, 'temp')
-import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
-load_dotenv()
+# Configuration parameters
+model_name = "deepseek-chat"  # Model used for every request in this stage
+batch_rounds = 3  # Attempts for chunks missing from batched responses
+batch_completion_tokens_per_chunk = 128  # Completion tokens reserved per chunk in a batch
+max_completion_tokens = 8192  # Provider limit for a single completion
 
-cumulative_characters = []
-client = OpenAI(
-    api_key=os.getenv("API_KEY"),
-    base_url="https://api.deepseek.com"
+# Instructions shared by the per-chunk and batched prompts
+character_instructions = (
+    "Identify the names of characters mentioned in the text and resolve pronouns or relational terms "
+    "to determine the specific individuals they refer to (e.g., identify who 'he' or 'she' refers to, "
+    "and clarify whose 'dad' or 'mom' is being mentioned) based on the context. Only replace 'I' with 'Narrator' "
+    "if the text is written in the first person and the narrator is relevant to the context. "
+    "If the text is not written in the first person, exclude the narrator from the list of characters. "
 )
 
-# Load chunks data
-with open(os.path.join(temp_dir, 'chunks.json'), 'r') as infile:
-    chunks = json.load(infile)
 
 # Function to process each chunk
-def process_chunk(idx, chunk):
+async def process_chunk(idx, chunk):
     text = chunk['text']
     # Craft the prompt to ensure no comments in the JSON response
     prompt = (
-        f"Identify the names of characters mentioned in the text and resolve pronouns or relational terms "
-        f"to determine the specific individuals they refer to (e.g., identify who 'he' or 'she' refers to, "
-        f"and clarify whose 'dad' or 'mom' is being mentioned) based on the context. Only replace 'I' with 'Narrator' "
-        f"if the text is written in the first person and the narrator is relevant to the context. "
-        f"If the text is not written in the first person, exclude the narrator from the list of characters. "
+        character_instructions +
         f"Respond with a valid JSON array of character names, such as [\"Character1\", \"Character2\"]. "
         f"Ensure the output is valid JSON without any comments or explanations. "
         f"Text: {text}"
     )
 
-    retries = 3
-    for attempt in range(retries):
+    request = dict(
+        model=model_name,  # llama-3.1-8b-instant
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0,  # Deterministic, so answers for identical chunks are reused from the response cache
+        max_completion_tokens=1024,
+        top_p=1,
+        stream=False,
+        response_format={"type": "json_object"},  # Corrected response format
+        stop=None,
+    )
+
+    try:
+        # Send request to Groq API. A response without content is treated as unparseable.
+        generated_text = await llm_client.chat(request) or ""
+    except Exception as err:
+        print(f"An error occurred for chunk {idx + 1}: {err}. Moving on to the next chunk.")
+        llm_client.record_failure()
+        return None
+
+    # Find the JSON list within the response
+    start = generated_text.find('[')
+    end = generated_text.rfind(']')
+    if start != -1 and end != -1 and end > start:
+        json_str = generated_text[start:end+1]
         try:
-            # Send request to Groq API
-            completion = client.chat.completions.create(
-                model="deepseek-chat",  # llama-3.1-8b-instant
-                messages=[{"role": "user", "content": prompt}],
-                temperature=1,
-                max_completion_tokens=1024,
-                top_p=1,
-                stream=False,
-                response_format={"type": "json_object"},  # Corrected response format
-                stop=None,
-            )
-
-            # Extract the generated text from the response
-            generated_text = completion.choices[0].message.content
-
-            # Find the JSON list within the response
-            start = generated_text.find('[')
-            end = generated_text.rfind(']')
-            if start != -1 and end != -1 and end > start:
-                json_str = generated_text[start:end+1]
-                try:
-                    characters = json.loads(json_str)
-                    if isinstance(characters, list):
-                        # Add the chunk number and characters to cumulative_characters
-                        return {"chunk_num": idx+1, "characters": characters}
-                    else:
-                        print(f"Invalid response format for chunk {idx + 1}")
-                except json.JSONDecodeError as json_err:
-                    print(f"JSON decode error for chunk {idx + 1}: {json_err}")
-            else:
-                print(f"No JSON list found in response for chunk {idx + 1}")
-            break  # Break out of the retry loop if successful
-        except Exception as err:
-            print(f"An error occurred for chunk {idx + 1}, attempt {attempt + 1}/{retries}: {err}")
-            if attempt < retries - 1:
-                time.sleep(2)  # Wait for 2 seconds before retrying
+            characters = json.loads(json_str)
+            if isinstance(characters, list):
+                # Add the chunk number and characters to cumulative_characters
+                return {"chunk_num": idx+1, "characters": characters}
             else:
-                print(f"Failed after {retries} attempts. Moving on to the next chunk.")
-    return None  # Return None if all attempts fail
-
-# Process chunks in parallel with a maximum of 10 threads
-with ThreadPoolExecutor(max_workers=100) as executor:
-    future_to_chunk = {executor.submit(process_chunk, idx, chunk): idx for idx, chunk in enumerate(chunks)}
-    for future in as_completed(future_to_chunk):
-        result = future.result()
+                print(f"Invalid response format for chunk {idx + 1}")
+        except json.JSONDecodeError as json_err:
+            print(f"JSON decode error for chunk {idx + 1}: {json_err}")
+    else:
+        print(f"No JSON list found in response for chunk {idx + 1}")
+    # Do not keep serving a response that could not be used
+    discard_cached_completion(request)
+    llm_client.record_failure()
+    return None
+
+
+# Collect the characters mentioned in every chunk
+def extract_chunk_characters(chunks):
+    cumulative_characters = []
+
+    # Process chunks concurrently; llm_client adapts the concurrency to the provider's limits
+    results = llm_client.run_all([process_chunk(idx, chunk) for idx, chunk in enumerate(chunks)])
+    for result in results:
         if result:
             cumulative_characters.append(result)
             print(f"Processed chunk {result['chunk_num']}/{len(chunks)}")
+    return cumulative_characters
 
-# Save the cumulative characters data to a JSON file
-with open(os.path.join(temp_dir, 'cumulative_characters.json'), 'w') as outfile:
-    json.dump(cumulative_characters, outfile, indent=4)
-
-print("Cumulative characters saved to 'cumulative_characters.json'.")
-
-# Collect all unique character names across all chunks
-all_characters = set()
-for chunk in cumulative_characters:
-    all_characters.update(chunk['characters'])
-
-# Fine-tune the character list by standardizing names
-refine_prompt = (
-    "Given the following list of character names, standardize the names to ensure consistency. "
-    "For example, if 'harry potter' and 'Harry Potter' appear, standardize them to 'Harry Potter'. "
-    "If there are synonymous names (e.g., 'You-Know-Who' and 'Voldemort'), always keep the most descriptive and canonical name (e.g., 'Voldemort'). "
-    "Remove any nicknames, titles, or alternative references that are less descriptive. "
-    "Ensure that the response is **only** a valid JSON list of standardized character names, like [\"Character1\", \"Character2\"]. "
-    "Do **not** include any additional comments, explanations, or metadata in the response. "
-    "List: " + json.dumps(list(all_characters))
-)
 
-# Retry logic for refining the character list
-retries = 3
-for attempt in range(retries):
+# Group chunks into batches whose text fits in roughly token_budget prompt tokens
+def build_batches(chunks, token_budget):
+    batches = []
+    current = []
+    current_tokens = 0
+    for chunk in chunks:
+        chunk_tokens = len(chunk['text']) // 4
+        if current and current_tokens + chunk_tokens > token_budget:
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(chunk)
+        current_tokens += chunk_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+# Extract the characters of several chunks with one request.
+# Returns a dict of chunk_num to characters for the chunks the response covered.
+async def process_batch(batch):
+    chunk_texts = "\n\n".join(f"Chunk {chunk['chunk_num']}:\n{chunk['text']}" for chunk in batch)
+    prompt = (
+        f"Below are {len(batch)} numbered chunks of text. Treat each chunk separately. " +
+        character_instructions +
+        f"Respond with a valid JSON object whose keys are the chunk numbers and whose values are JSON arrays "
+        f"of character names, such as {{\"{batch[0]['chunk_num']}\": [\"Character1\", \"Character2\"]}}. "
+        f"Include every chunk number, using an empty array if a chunk mentions no characters. "
+        f"Ensure the output is valid JSON without any comments or explanations.\n\n"
+        f"{chunk_texts}"
+    )
+
+    request = dict(
+        model=model_name,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0,  # Deterministic, so answers for identical batches are reused from the response cache
+        max_completion_tokens=min(max_completion_tokens, 256 + batch_completion_tokens_per_chunk * len(batch)),
+        top_p=1,
+        stream=False,
+        response_format={"type": "json_object"},
+        stop=None,
+    )
+
+    chunk_range = f"{batch[0]['chunk_num']}-{batch[-1]['chunk_num']}"
+    try:
+        generated_text = await llm_client.chat(request) or ""
+        response = json.loads(generated_text)
+    except json.JSONDecodeError as json_err:
+        print(f"JSON decode error for chunks {chunk_range}: {json_err}")
+        # Do not keep serving a response that could not be used
+        discard_cached_completion(request)
+        return {}
+    except Exception as err:
+        print(f"An error occurred for chunks {chunk_range}: {err}")
+        return {}
+
+    found = {}
+    if isinstance(response, dict):
+        for chunk in batch:
+            characters = response.get(str(chunk['chunk_num']))
+            if isinstance(characters, list):
+                found[chunk['chunk_num']] = characters
+    if not found:
+        print(f"Invalid response format for chunks {chunk_range}")
+        discard_cached_completion(request)
+    return found
+
+
+# Collect the characters mentioned in every chunk, packing several chunks into each request.
+# Only chunks missing from a malformed or partial response are retried, in smaller batches.
+def extract_chunk_characters_batched(chunks, token_budget):
+    found = {}
+    pending = list(chunks)
+    for round_num in range(batch_rounds):
+        if not pending:
+            break
+        batches = build_batches(pending, max(1, token_budget >> round_num))
+        print(f"Extracting characters from {len(pending)} chunks in {len(batches)} batches...")
+        for result in llm_client.run_all([process_batch(batch) for batch in batches]):
+            found.update(result)
+        pending = [chunk for chunk in pending if chunk['chunk_num'] not in found]
+        if pending:
+            print(f"{len(pending)} chunks missing from batched responses.")
+
+    if pending:
+        print(f"Failed after {batch_rounds} attempts for chunks {[chunk['chunk_num'] for chunk in pending]}. Moving on.")
+        llm_client.record_failure()
+    return [
+        {"chunk_num": chunk['chunk_num'], "characters": found[chunk['chunk_num']]}
+        for chunk in chunks
+        if chunk['chunk_num'] in found
+    ]
+
+
+# Standardize character names across all chunks in place
+def refine_character_names(cumulative_characters):
+    # Collect all unique character names across all chunks
+    all_characters = set()
+    for chunk in cumulative_characters:
+        all_characters.update(chunk['characters'])
+
+    # Fine-tune the character list by standardizing names
+    refine_prompt = (
+        "Given the following list of character names, standardize the names to ensure consistency. "
+        "For example, if 'harry potter' and 'Harry Potter' appear, standardize them to 'Harry Potter'. "
+        "If there are synonymous names (e.g., 'You-Know-Who' and 'Voldemort'), always keep the most descriptive and canonical name (e.g., 'Voldemort'). "
+        "Remove any nicknames, titles, or alternative references that are less descriptive. "
+        "Ensure that the response is **only** a valid JSON list of standardized character names, like [\"Character1\", \"Character2\"]. "
+        "Do **not** include any additional comments, explanations, or metadata in the response. "
+        "List: " + json.dumps(list(all_characters))
+    )
+
     try:
         # Send request to Groq API to refine the character list
-        refine_completion = client.chat.completions.create(
-            model="deepseek-chat",  # llama-3.1-70b-versatile
+        refined_text = llm_client.run(llm_client.chat(dict(
+            model=model_name,  # llama-3.1-70b-versatile
             messages=[{"role": "user", "content": refine_prompt}],
             temperature=0.7,
             max_completion_tokens=1024,
@@ -126,48 +212,77 @@ for attempt in range(retries):
             stream=False,
             response_format={"type": "json_object"},  # Corrected response format
             stop=None,
-        )
-
-        # Extract the refined character list from the response
-        refined_text = refine_completion.choices[0].message.content
-
-        # Find the JSON list within the response
-        start = refined_text.find('[')
-        end = refined_text.rfind(']')
-        if start != -1 and end != -1 and end > start:
-            json_str = refined_text[start:end+1]
-            try:
-                refined_characters = json.loads(json_str)
-                if isinstance(refined_characters, list):
-                    # Create a mapping from original names to standardized names
-                    name_mapping = {}
-                    for original_name in all_characters:
-                        for standardized_name in refined_characters:
-                            if original_name.lower() == standardized_name.lower():
-                                name_mapping[original_name] = standardized_name
-                                break
-
-                    # Update each chunk's character list with standardized names
-                    for chunk in cumulative_characters:
-                        chunk['characters'] = [name_mapping.get(name, name) for name in chunk['characters']]
-
-                    print("Character names standardized successfully.")
-                else:
-                    print("Invalid response format for refined character list.")
-            except json.JSONDecodeError as json_err:
-                print(f"JSON decode error in refined list: {json_err}")
-        else:
-            print("No JSON list found in refined response.")
-        break  # Break out of the retry loop if successful
+        ))) or ""
     except Exception as err:
-        print(f"An error occurred while refining the character list, attempt {attempt + 1}/{retries}: {err}")
-        if attempt < retries - 1:
-            time.sleep(2)  # Wait for 2 seconds before retrying
-        else:
-            print(f"Failed after {retries} attempts. Moving on.")
+        print(f"An error occurred while refining the character list: {err}. Moving on.")
+        llm_client.record_failure()
+        return cumulative_characters
+
+    # Find the JSON list within the response
+    start = refined_text.find('[')
+    end = refined_text.rfind(']')
+    if start != -1 and end != -1 and end > start:
+        json_str = refined_text[start:end+1]
+        try:
+            refined_characters = json.loads(json_str)
+            if isinstance(refined_characters, list):
+                # Create a mapping from original names to standardized names
+                name_mapping = {}
+                for original_name in all_characters:
+                    for standardized_name in refined_characters:
+                        if original_name.lower() == standardized_name.lower():
+                            name_mapping[original_name] = standardized_name
+                            break
+
+                # Update each chunk's character list with standardized names
+                for chunk in cumulative_characters:
+                    chunk['characters'] = [name_mapping.get(name, name) for name in chunk['characters']]
+
+                print("Character names standardized successfully.")
+            else:
+                print("Invalid response format for refined character list.")
+                llm_client.record_failure()
+        except json.JSONDecodeError as json_err:
+            print(f"JSON decode error in refined list: {json_err}")
+            llm_client.record_failure()
+    else:
+        print("No JSON list found in refined response.")
+        llm_client.record_failure()
+    return cumulative_characters
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract the characters of every chunk in chunks.json.")
+    workspace.add_argument(parser)
+    parser.add_argument('--batch-tokens', type=int, default=0,
+                        help="Pack chunks into requests of about this many prompt tokens (default: one request per chunk).")
+    args = parser.parse_args()
+
+    temp_dir = args.workspace
+
+    # Load chunks data
+    with open(os.path.join(temp_dir, 'chunks.json'), 'r') as infile:
+        chunks = json.load(infile)
+
+    if args.batch_tokens > 0:
+        cumulative_characters = extract_chunk_characters_batched(chunks, args.batch_tokens)
+    else:
+        cumulative_characters = extract_chunk_characters(chunks)
+
+    # Save the cumulative characters data to a JSON file
+    with open(os.path.join(temp_dir, 'cumulative_characters.json'), 'w') as outfile:
+        json.dump(cumulative_characters, outfile, indent=4)
+
+    print("Cumulative characters saved to 'cumulative_characters.json'.")
+
+    refine_character_names(cumulative_characters)
+
+    # Save the refined characters to a JSON file
+    with open(os.path.join(temp_dir, 'characters.json'), 'w') as outfile:
+        json.dump(cumulative_characters, outfile, indent=4)
+
+    print("Characters saved to 'characters.json'.")
 
-# Save the refined characters to a JSON file
-with open(os.path.join(temp_dir, 'characters.json'), 'w') as outfile:
-    json.dump(cumulative_characters, outfile, indent=4)
 
-print("Characters saved to 'characters.json'.")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,91 +1,163 @@
 import json
-from openai import OpenAI
-from dotenv import load_dotenv
 import os
-import time
+import llm_client
+import workspace
 
 # Get project root directory
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-temp_dir = os.path.join(PROJECT_ROOT, 'temp')
-
-load_dotenv()
-
-client = OpenAI(
-    api_key=os.getenv("API_KEY"),
-    base_url="https://api.deepseek.com"
-)
-
-# Load chunks data
-with open(os.path.join(temp_dir, 'chunks.json'), 'r') as infile:
-    chunks = json.load(infile)
-
-# Create a summarized version of all chunks
-summarized_chunks = []
-for idx, chunk in enumerate(chunks):
-    summarized_chunks.append({
-        "chunk_num": idx + 1,
-        "page_nums": chunk["page_nums"],
-        "summary": f"Chunk {idx + 1} (Pages {chunk['page_nums']}): {chunk['text'][:200]}..."  # Truncate text for summary
-    })
-
-# Combine all summaries into a single prompt
-summarized_text = "\n\n".join([chunk["summary"] for chunk in summarized_chunks])
-
-# Craft a prompt to identify the top 5-10 important chunks
-prompt = (
-    f"Below is a summarized version of all chunks in a document. Each chunk is labeled with its number, page numbers, and a brief summary.\n\n"
-    f"Summarized Chunks:\n{summarized_text}\n\n"
-    f"Identify the **top 5-10 most important chunks** based on the following criteria:\n"
-    f"- The chunk significantly advances the plot or changes the direction of the story.\n"
-    f"- The chunk involves major decisions, conflicts, or resolutions by key characters.\n"
-    f"- The chunk has a lasting impact on the narrative or characters.\n\n"
-    f"Respond with a JSON object containing the key 'important_chunks', which is a list of chunk numbers (e.g., [1, 5, 7]). "
-    f"Only include the most pivotal chunks. Do not include minor details or routine actions.\n\n"
-    f"Important Chunks:"
-)
-
-# Retry mechanism
-retries = 3
-for attempt in range(retries):
-    try:
-        # Send request to Deepseek API
-        completion = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3,  # Lower temperature for more focused responses
-            max_completion_tokens=1024,
-            top_p=0.9,  # Slightly lower top_p to reduce randomness
-            stream=False,
-            response_format={"type": "json_object"},
-            stop=None,
-        )
-
-        # Extract the generated text from the response
-        generated_text = completion.choices[0].message.content
 
-        # Parse the JSON response
-        try:
-            response = json.loads(generated_text)
-            if isinstance(response, dict) and "important_chunks" in response:
-                important_chunks = response["important_chunks"]
-                print(f"Identified important chunks: {important_chunks}")
+# Configuration parameters
+model_name = "deepseek-chat"  # Model used for every request in this stage
+selection_mode = os.getenv("EVENTS_SELECTION", "auto")  # 'single' prompt, 'hierarchical' map-reduce, or 'auto' (single while it fits)
+max_prompt_tokens = 24000  # Largest single prompt 'auto' sends before switching to hierarchical selection
+window_chunks = 40  # Chunks shown per prompt in hierarchical selection
+candidates_per_window = 5  # Candidates kept from each window for the next round
+
+
+# Helper function to describe a chunk by the start of its text
+def excerpt_line(chunk):
+    return f"Chunk {chunk['chunk_num']} (Pages {chunk['page_nums']}): {chunk['text'][:200]}..."  # Truncate text for summary
+
+
+# Helper function to describe a chunk by its 1-sentence summary, or its excerpt if it has none
+def summary_line(chunk):
+    summary = chunk.get("summary")
+    if not summary or summary == "No summary available.":
+        return excerpt_line(chunk)
+    return f"Chunk {chunk['chunk_num']} (Pages {chunk['page_nums']}): {summary}"
+
 
-                # Filter the original chunks to include only the important ones
-                important_chunks_details = [chunk for chunk in chunks if chunk["chunk_num"] in important_chunks]
+# Helper function to build the prompt asking for the count most important of the described chunks
+def selection_prompt(description, summarized_text, count):
+    return (
+        f"Below is {description}. Each chunk is labeled with its number, page numbers, and a brief summary.\n\n"
+        f"Summarized Chunks:\n{summarized_text}\n\n"
+        f"Identify the **{count} most important chunks** based on the following criteria:\n"
+        f"- The chunk significantly advances the plot or changes the direction of the story.\n"
+        f"- The chunk involves major decisions, conflicts, or resolutions by key characters.\n"
+        f"- The chunk has a lasting impact on the narrative or characters.\n\n"
+        f"Respond with a JSON object containing the key 'important_chunks', which is a list of chunk numbers (e.g., [1, 5, 7]). "
+        f"Only include the most pivotal chunks. Do not include minor details or routine actions.\n\n"
+        f"Important Chunks:"
+    )
 
-                # Save the important chunks to a JSON file
-                with open(os.path.join(temp_dir, 'important_chunks.json'), 'w') as outfile:
-                    json.dump(important_chunks_details, outfile, indent=4)
 
-                print("Important chunks saved to 'important_chunks.json'.")
-                break  # Exit the retry loop if successful
+# Ask the model which chunks a selection prompt points to. Returns the list of chunk
+# numbers, or None if no valid answer was received.
+async def select_chunk_nums(prompt):
+    # Retry mechanism for unusable responses (llm_client retries throttling and server errors)
+    retries = 3
+    for attempt in range(retries):
+        try:
+            # Send request to Deepseek API
+            generated_text = await llm_client.chat(dict(
+                model=model_name,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.3,  # Lower temperature for more focused responses
+                max_completion_tokens=1024,
+                top_p=0.9,  # Slightly lower top_p to reduce randomness
+                stream=False,
+                response_format={"type": "json_object"},
+                stop=None,
+            ))
+        except Exception as err:
+            print(f"An error occurred: {err}. Exiting.")
+            llm_client.record_failure()
+            return None
+
+        # Parse the JSON response
+        try:
+            # A response without content is treated as unparseable and asked for again
+            response = json.loads(generated_text or "")
+            if isinstance(response, dict) and isinstance(response.get("important_chunks"), list):
+                return response["important_chunks"]
             else:
-                print("Invalid response format. Expected 'important_chunks' key.")
+                print(f"Invalid response format on attempt {attempt + 1}/{retries}. Expected 'important_chunks' key.")
         except json.JSONDecodeError as json_err:
-            print(f"JSON decode error: {json_err}")
-    except Exception as err:
-        print(f"An error occurred on attempt {attempt + 1}/{retries}: {err}")
-        if attempt < retries - 1:
-            time.sleep(2)  # Wait for 2 seconds before retrying
-        else:
-            print("Failed after 3 attempts. Exiting.")
\ No newline at end of file
+            print(f"JSON decode error on attempt {attempt + 1}/{retries}: {json_err}")
+    print(f"Failed after {retries} attempts. Exiting.")
+    llm_client.record_failure()
+    return None
+
+
+# Ask the model for the most important chunks. Returns None if no valid answer was received.
+# The whole document goes in one prompt unless it would exceed max_prompt_tokens (or
+# selection_mode says otherwise), in which case the selection is made hierarchically.
+def find_important_chunks(chunks):
+    # Combine a summarized version of all chunks into a single prompt
+    summarized_text = "\n\n".join(excerpt_line(chunk) for chunk in chunks)
+    prompt = selection_prompt("a summarized version of all chunks in a document", summarized_text, "top 5-10")
+    if selection_mode == 'hierarchical' or selection_mode == 'auto' and len(prompt) // 4 > max_prompt_tokens:
+        return find_important_chunks_hierarchical(chunks)
+
+    important_chunks = llm_client.run(select_chunk_nums(prompt))
+    if important_chunks is None:
+        return None
+    print(f"Identified important chunks: {important_chunks}")
+
+    # Filter the original chunks to include only the important ones
+    return [chunk for chunk in chunks if chunk["chunk_num"] in important_chunks]
+
+
+# Map-reduce selection with prompts of at most window_chunks chunks. Every window of chunks
+# nominates up to candidates_per_window candidates, all windows at once; rounds repeat over
+# the candidates' summaries until they fit in one prompt, which picks the final chunks.
+# Returns None if any request received no valid answer.
+def find_important_chunks_hierarchical(chunks):
+    candidates = chunks
+    describe = excerpt_line  # The first round sees the chunk texts, later rounds the summaries
+    round_num = 1
+    while len(candidates) > window_chunks:
+        windows = [candidates[i:i + window_chunks] for i in range(0, len(candidates), window_chunks)]
+        print(f"Round {round_num}: selecting candidates from {len(candidates)} chunks in {len(windows)} windows...")
+        prompts = [
+            selection_prompt(
+                f"a summarized version of the chunks in one part of a document (pages "
+                f"{window[0]['page_nums'][0]}-{window[-1]['page_nums'][-1]})",
+                "\n\n".join(describe(chunk) for chunk in window),
+                f"top {candidates_per_window}",
+            )
+            for window in windows
+        ]
+        results = llm_client.run_all([select_chunk_nums(prompt) for prompt in prompts])
+        if any(result is None for result in results):
+            return None
+
+        # Keep at most candidates_per_window per window, so every round shrinks the candidates
+        candidates = []
+        for window, result in zip(windows, results):
+            chosen = set(result)
+            candidates.extend([chunk for chunk in window if chunk["chunk_num"] in chosen][:candidates_per_window])
+        describe = summary_line
+        round_num += 1
+
+    print(f"Selecting the important chunks from {len(candidates)} candidates...")
+    summarized_text = "\n\n".join(summary_line(chunk) for chunk in candidates)
+    description = "a summarized version of the candidate key chunks of a document, chosen from each of its parts"
+    important_chunks = llm_client.run(select_chunk_nums(selection_prompt(description, summarized_text, "top 5-10")))
+    if important_chunks is None:
+        return None
+    print(f"Identified important chunks: {important_chunks}")
+    return [chunk for chunk in candidates if chunk["chunk_num"] in important_chunks]
+
+
+def main():
+    temp_dir = workspace.parse_workspace("Find the most important chunks in chunks.json.")
+
+    # Load chunks data
+    with open(os.path.join(temp_dir, 'chunks.json'), 'r') as infile:
+        chunks = json.load(infile)
+
+    important_chunks_details = find_important_chunks(chunks)
+    if important_chunks_details is None:
+        return
+
+    # Save the important chunks to a JSON file
+    with open(os.path.join(temp_dir, 'important_chunks.json'), 'w') as outfile:
+        json.dump(important_chunks_details, outfile, indent=4)
+
+    print("Important chunks saved to 'important_chunks.json'.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Get project root directory
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Configuration parameters
+cache_path = os.path.join(PROJECT_ROOT, 'cache', 'llm_cache.sqlite3')  # Shared by the parser and the server
+ttl_seconds = int(os.getenv("LLM_CACHE_TTL_SECONDS", 30 * 24 * 3600))  # Entries older than this are ignored and removed
+max_cache_bytes = int(os.getenv("LLM_CACHE_MAX_BYTES", 256 << 20))  # Size cap before least recently used entries are evicted
+cache_enabled = os.getenv("LLM_CACHE_DISABLED", "") == ""
+evict_every = 100  # Number of inserts between eviction passes
+
+# Request parameters that change the response and therefore belong in the key
+key_params = ("model", "messages", "temperature", "top_p", "max_completion_tokens", "response_format", "stop")
+
+# One connection per thread, since sqlite3 connections cannot be shared across threads
+_local = threading.local()
+_inserts = 0
+
+
+# Helper function to get this thread's connection, creating the table on first use
+def _connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        conn = sqlite3.connect(cache_path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+            "created REAL NOT NULL, last_used REAL NOT NULL, size INTEGER NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        conn.commit()
+        _local.conn = conn
+    return conn
+
+
+# Helper function to build the cache key of a request
+def request_key(request):
+    keyed = {name: request.get(name) for name in key_params}
+    return hashlib.sha256(json.dumps(keyed, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# Only deterministic requests are cached unless the caller explicitly allows sampled ones
+def is_cacheable(request, allow_sampled=False):
+    if not cache_enabled or request.get("stream"):
+        return False
+    return allow_sampled or request.get("temperature", 1) == 0
+
+
+# Return the cached response content for a request, or None if it is not cached
+def lookup(request):
+    key = request_key(request)
+    now = time.time()
+    conn = _connection()
+    row = conn.execute(
+        "SELECT response FROM responses WHERE key = ? AND created >= ?", (key, now - ttl_seconds)
+    ).fetchone()
+    if row is None:
+        return None
+    conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+    conn.commit()
+    return row[0]
+
+
+# Store the response content for a request
+def store(request, content):
+    global _inserts
+    if content is None:
+        return
+    now = time.time()
+    conn = _connection()
+    conn.execute(
+        "INSERT OR REPLACE INTO responses (key, response, created, last_used, size) VALUES (?, ?, ?, ?, ?)",
+        (request_key(request), content, now, now, len(content.encode('utf-8')))
+    )
+    conn.commit()
+    _inserts += 1
+    if _inserts % evict_every == 0:
+        evict()
+
+
+# Send a chat completion request and return the message content, serving
+# repeated requests from the on-disk cache
+def cached_chat_completion(client, request, allow_sampled=False):
+    if not is_cacheable(request, allow_sampled):
+        return client.chat.completions.create(**request).choices[0].message.content
+
+    content = lookup(request)
+    if content is None:
+        content = client.chat.completions.create(**request).choices[0].message.content
+        store(request, content)
+    return content
+
+
+# Drop a cached response, e.g. when it could not be parsed, so the next attempt asks the model again
+def discard_cached_completion(request):
+    if not cache_enabled:
+        return
+    conn = _connection()
+    conn.execute("DELETE FROM responses WHERE key = ?", (request_key(request),))
+    conn.commit()
+
+
+# Remove expired entries, then least recently used ones until the cache fits in max_cache_bytes
+def evict():
+    conn = _connection()
+    conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - ttl_seconds,))
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+    if total > max_cache_bytes:
+        removed = 0
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall():
+            if total - removed <= max_cache_bytes:
+                break
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            removed += size
+    conn.commit()
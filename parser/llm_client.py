@@ -0,0 +1,212 @@
+import asyncio
+import os
+import random
+import threading
+import time
+import httpx
+import openai
+from dotenv import load_dotenv
+
+import llm_cache
+
+load_dotenv()
+
+# Configuration parameters
+base_url = "https://api.deepseek.com"
+requests_per_minute = int(os.getenv("LLM_REQUESTS_PER_MINUTE", 600))  # Request rate limit
+tokens_per_minute = int(os.getenv("LLM_TOKENS_PER_MINUTE", 1000000))  # Prompt + completion token rate limit
+initial_concurrency = int(os.getenv("LLM_INITIAL_CONCURRENCY", 8))  # Requests in flight before any feedback
+max_concurrency = int(os.getenv("LLM_MAX_CONCURRENCY", 64))  # Upper bound for the adaptive limit
+max_connections = int(os.getenv("LLM_MAX_CONNECTIONS", 64))  # Size of the keep-alive connection pool
+retries = 3  # Attempts per request for throttling, server and connection errors
+
+
+# Rough token count of a request, used for the token rate limit
+def estimate_tokens(request):
+    prompt_chars = sum(len(message.get("content") or "") for message in request.get("messages", []))
+    return prompt_chars // 4 + request.get("max_completion_tokens", 0)
+
+
+# Token bucket refilled continuously at rate units per second, holding at most capacity units
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        # A single request larger than the bucket only has to wait for a full bucket
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+# Concurrency limit with additive increase on success and multiplicative decrease on throttling.
+# Other errors leave the limit unchanged.
+class AIMDLimiter:
+    def __init__(self, initial, minimum=1, maximum=64, decrease_interval=1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_interval = decrease_interval  # A burst of 429s only halves the limit once
+        self.last_decrease = 0.0
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            while self.in_flight >= int(self.limit):
+                await self.condition.wait()
+            self.in_flight += 1
+
+    async def release(self, succeeded=False, throttled=False):
+        async with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                if now - self.last_decrease >= self.decrease_interval:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.last_decrease = now
+                    print(f"Provider throttling, reducing LLM concurrency to {int(self.limit)}.")
+            elif succeeded:
+                # Grows by about one slot per limit's worth of successful requests
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+# Rate-limited, adaptively concurrent client shared by every pipeline stage
+class LLMClient:
+    def __init__(self):
+        self.client = openai.AsyncOpenAI(
+            api_key=os.getenv("API_KEY"),
+            base_url=base_url,
+            max_retries=0,  # Retries are handled here so they go through the limits
+            http_client=openai.DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections,
+                )
+            ),
+        )
+        self.request_bucket = TokenBucket(requests_per_minute / 60, max(1, requests_per_minute // 60))
+        self.token_bucket = TokenBucket(tokens_per_minute / 60, max(1, tokens_per_minute // 60))
+        self.limiter = AIMDLimiter(initial_concurrency, maximum=max_concurrency)
+
+    # Send a chat completion request and return the message content.
+    # Cacheable requests are served from the shared response cache.
+    async def chat(self, request, allow_sampled=False):
+        cacheable = llm_cache.is_cacheable(request, allow_sampled)
+        if cacheable:
+            content = llm_cache.lookup(request)
+            if content is not None:
+                return content
+
+        for attempt in range(retries):
+            await self.request_bucket.acquire()
+            await self.token_bucket.acquire(estimate_tokens(request))
+            await self.limiter.acquire()
+            succeeded = False
+            throttled = False
+            try:
+                completion = await self.client.chat.completions.create(**request)
+            except openai.RateLimitError as err:
+                throttled = True
+                error = err
+            except (openai.APIConnectionError, openai.InternalServerError) as err:
+                error = err
+            else:
+                succeeded = True
+                content = completion.choices[0].message.content
+                if cacheable:
+                    llm_cache.store(request, content)
+                return content
+            finally:
+                await self.limiter.release(succeeded, throttled)
+
+            if attempt == retries - 1:
+                raise error
+            print(f"LLM request failed (attempt {attempt + 1}/{retries}): {error}")
+            await asyncio.sleep(retry_delay(error, attempt))
+
+
+# Helper function to pick the wait before a retry, honouring Retry-After when the provider sends it
+def retry_delay(error, attempt):
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    # Exponential backoff with jitter
+    return (2 ** attempt) * (1 + random.random())
+
+
+# Every stage submits its requests to one background event loop, so the connection
+# pool, rate limits and concurrency limit are shared for the whole process
+_loop = None
+_client = None
+_lock = threading.Lock()
+
+
+def _get_loop():
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="llm-client", daemon=True).start()
+    return _loop
+
+
+# Get the process-wide client. Must be called from the background loop.
+def get_client():
+    global _client
+    if _client is None:
+        _client = LLMClient()
+    return _client
+
+
+# Shortcut for get_client().chat(...)
+async def chat(request, allow_sampled=False):
+    return await get_client().chat(request, allow_sampled)
+
+
+# Run a coroutine on the background loop and wait for its result
+def run(coro):
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+
+async def _gather(coros):
+    return await asyncio.gather(*coros)
+
+
+# Run coroutines concurrently on the background loop and return their results in order
+def run_all(coros):
+    return run(_gather(coros))
+
+
+# Answers a stage could not use and replaced with a fallback. The pipeline does not cache
+# the output of a stage that had any, so re-running it retries them.
+_failures = 0
+
+
+# Count a request whose answer could not be used
+def record_failure():
+    global _failures
+    with _lock:
+        _failures += 1
+
+
+# Number of failures recorded so far in this process
+def failure_count():
+    return _failures
@@ -0,0 +1,61 @@
+import json
+import numpy as np
+
+# Sentence embeddings on CPU with onnxruntime and the tokenizers library, for the
+# exported ONNX models that sentence-transformers publishes on the Hugging Face hub.
+# Avoids importing torch and sentence_transformers, which dominates start-up time
+# when only a few hundred short strings need embedding.
+
+# Configuration parameters
+default_model_file = 'onnx/model_quint8_avx2.onnx'  # int8-quantized export, runs on any AVX2 CPU
+default_max_seq_length = 128  # Used when the model does not declare its own
+
+
+# Drop-in replacement for SentenceTransformer(...).encode for mean-pooled models
+class OnnxEmbedder:
+    def __init__(self, model_name, model_file=default_model_file):
+        # Imported here so the module itself stays cheap to import
+        import onnxruntime
+        from huggingface_hub import hf_hub_download
+        from tokenizers import Tokenizer
+
+        repo_id = model_name if '/' in model_name else f'sentence-transformers/{model_name}'
+        try:
+            with open(hf_hub_download(repo_id, 'sentence_bert_config.json'), 'r') as infile:
+                max_seq_length = json.load(infile).get('max_seq_length', default_max_seq_length)
+        except Exception:
+            max_seq_length = default_max_seq_length
+
+        self.tokenizer = Tokenizer.from_file(hf_hub_download(repo_id, 'tokenizer.json'))
+        self.tokenizer.enable_truncation(max_length=max_seq_length)
+        self.tokenizer.enable_padding()
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(
+            hf_hub_download(repo_id, model_file), options, providers=['CPUExecutionProvider']
+        )
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+    # Return a float32 matrix with one embedding per text
+    def encode(self, texts, batch_size=32):
+        embeddings = []
+        for start in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(list(texts[start:start + batch_size]))
+            attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+            inputs = {
+                'input_ids': np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+                'attention_mask': attention_mask,
+                'token_type_ids': np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+            }
+            token_embeddings = self.session.run(
+                None, {name: value for name, value in inputs.items() if name in self.input_names}
+            )[0]
+
+            # Mean pooling over the real (unpadded) tokens, as the sentence-transformers models do
+            mask = attention_mask[:, :, None].astype(np.float32)
+            summed = (token_embeddings * mask).sum(axis=1)
+            embeddings.append(summed / np.clip(mask.sum(axis=1), 1e-9, None))
+        if not embeddings:
+            return np.zeros((0, self.session.get_outputs()[0].shape[-1]), dtype=np.float32)
+        return np.vstack(embeddings).astype(np.float32)
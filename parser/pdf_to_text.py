@@ -1,35 +1,102 @@
 import pypdf
 import json
 import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import workspace
 
 # Get project root directory
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-text_data = []
-with open(PROJECT_ROOT + "/temp/input.pdf", 'rb') as file:
-    pdf_reader = pypdf.PdfReader(file)
-    num_pages = len(pdf_reader.pages)
-    for page_num in range(num_pages):
-        page = pdf_reader.pages[page_num]
-        text = page.extract_text()
-        if text is None:
-            continue
-        text_data_entry = {
-            'page_num': page_num,
-            'text': text
-        }
-        text_data.append(text_data_entry)
-        # print("Page:", page_num + 1)
-        # print(text)
-        # print("-" * 20)
-
-print(json.dumps(text_data, indent=4))
-
-# Ensure temp directory exists
-temp_dir = os.path.join(PROJECT_ROOT, 'temp')
-os.makedirs(temp_dir, exist_ok=True)
-
-with open(os.path.join(temp_dir, 'transcript.json'), 'w') as outfile:
-    json.dump(text_data, outfile, indent=4)
-
-print("Transcript saved to 'transcript.json'.")
+# Number of pages handed to a worker process at a time
+pages_per_task = 16
+
+
+# Extract the text of pages [start_page, end_page) from the PDF
+def extract_page_range(pdf_path, start_page, end_page):
+    text_data = []
+    with open(pdf_path, 'rb') as file:
+        pdf_reader = pypdf.PdfReader(file)
+        for page_num in range(start_page, end_page):
+            page = pdf_reader.pages[page_num]
+            text = page.extract_text()
+            if text is None:
+                continue
+            text_data.append({
+                'page_num': page_num,
+                'text': text
+            })
+    return text_data
+
+
+# Yield transcript entries in page order, extracting page ranges across a process pool
+def iter_pages(pdf_path, workers=1):
+    with open(pdf_path, 'rb') as file:
+        num_pages = len(pypdf.PdfReader(file).pages)
+
+    if workers <= 1:
+        for entry in extract_page_range(pdf_path, 0, num_pages):
+            yield entry
+        return
+
+    ranges = [(start, min(start + pages_per_task, num_pages)) for start in range(0, num_pages, pages_per_task)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map() hands results back in submission order, so pages stream out in order
+        # as soon as every earlier range has finished
+        results = executor.map(
+            extract_page_range,
+            [pdf_path] * len(ranges),
+            [start for start, _ in ranges],
+            [end for _, end in ranges],
+        )
+        for text_data in results:
+            for entry in text_data:
+                yield entry
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract the text of input.pdf into a transcript.")
+    workspace.add_argument(parser)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of extraction processes (0 = one per CPU, default 1).")
+    parser.add_argument('--jsonl', action='store_true',
+                        help="Stream pages to transcript.jsonl as they are extracted.")
+    parser.add_argument('--quiet', action='store_true',
+                        help="Do not dump the transcript to stdout.")
+    args = parser.parse_args()
+
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+
+    # Ensure the workspace exists
+    temp_dir = args.workspace
+    os.makedirs(temp_dir, exist_ok=True)
+    pdf_path = os.path.join(temp_dir, 'input.pdf')
+
+    if args.jsonl:
+        # Only one transcript format may exist at a time so later stages pick up the right one
+        if os.path.exists(os.path.join(temp_dir, 'transcript.json')):
+            os.remove(os.path.join(temp_dir, 'transcript.json'))
+        with open(os.path.join(temp_dir, 'transcript.jsonl'), 'w') as outfile:
+            for entry in iter_pages(pdf_path, workers):
+                line = json.dumps(entry)
+                outfile.write(line + "\n")
+                if not args.quiet:
+                    print(line)
+        print("Transcript saved to 'transcript.jsonl'.")
+        return
+
+    text_data = list(iter_pages(pdf_path, workers))
+
+    if not args.quiet:
+        print(json.dumps(text_data, indent=4))
+
+    if os.path.exists(os.path.join(temp_dir, 'transcript.jsonl')):
+        os.remove(os.path.join(temp_dir, 'transcript.jsonl'))
+    with open(os.path.join(temp_dir, 'transcript.json'), 'w') as outfile:
+        json.dump(text_data, outfile, indent=4)
+
+    print("Transcript saved to 'transcript.json'.")
+
+
+if __name__ == '__main__':
+    main()
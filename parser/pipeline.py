@@ -0,0 +1,276 @@
+import json
+import os
+import time
+import argparse
+
+# Every stage is imported once, so openai, dotenv and sentence_transformers
+# are only loaded once per run instead of once per script
+import pdf_to_text
+import txt_to_transcript
+import chunker_summary
+import chunk_analysis
+import extract_characters
+import extract_events
+import merge_events_chunks
+import results_generator
+import results_refiner
+import character_summary
+import character_timeline
+import context_index
+from stage_cache import StageCache, hash_file, hash_json
+from chunk_store import ChunkStore
+import story_store
+import llm_client
+import workspace
+
+# Get project root directory
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Run every parsing stage in this process, keeping intermediate results in memory.
+# transcript_key identifies the transcript's content. With a cache, stages whose
+# inputs and parameters are unchanged are loaded instead of recomputed. With debug
+# set, the usual stage artifacts are written to temp_dir (default temp/) after each stage. With fused set, each
+# chunk's summary and characters come from a single request; otherwise batch_tokens > 0
+# packs several chunks into each character extraction request. chunk_tokens > 0 switches
+# from fixed word windows to sentence-aligned chunks of about that many tokens. With
+# timelines set, each character's personality and sentiment timelines are added for the chatbot.
+# With build_index set, the contexts are embedded into an index next to the output that
+# the chatbot's retrieval mode searches.
+def run_pipeline(transcript, output_path, debug=False, cache=None, transcript_key=None, fused=False,
+                 batch_tokens=0, chunk_tokens=0, temp_dir=None, timelines=True,
+                 build_index=False):
+    temp_dir = temp_dir or workspace.default_workspace
+    if debug:
+        os.makedirs(temp_dir, exist_ok=True)
+    if transcript_key is None:
+        transcript_key = hash_json(transcript)
+
+    # Helper function to save an intermediate result in debug mode
+    def save_debug(filename, data):
+        if debug:
+            with open(os.path.join(temp_dir, filename), 'w') as outfile:
+                json.dump(data, outfile, indent=4)
+            print(f"[debug] Saved '{filename}'.")
+
+    # Helper function to time a stage, reusing its cached output when possible.
+    # Returns the stage output and its key, which later stages use as an input key.
+    def run_stage(name, input_keys, params, func, *args, cached=True):
+        if cache is not None:
+            key = cache.key(name, input_keys, params)
+            if cached:
+                result = cache.get(key)
+                if result is not None:
+                    print(f"Stage '{name}' loaded from cache.")
+                    return result, key
+        else:
+            key = hash_json({"stage": name, "inputs": input_keys, "params": params})
+        print(f"Stage '{name}' started.")
+        start = time.perf_counter()
+        failures = llm_client.failure_count()
+        result = func(*args)
+        print(f"Stage '{name}' finished in {time.perf_counter() - start:.2f}s.")
+        # An output holding fallbacks for failed requests is not cached, so the next run retries them
+        failed = llm_client.failure_count() - failures
+        if failed:
+            print(f"Stage '{name}' had {failed} failed requests; its output is not cached.")
+        elif cache is not None and cached:
+            cache.put(key, result)
+        return result, key
+
+    # Helper function to split the transcript with the configured chunker
+    def make_chunks(data):
+        if chunk_tokens > 0:
+            overlap_tokens = chunk_tokens * chunker_summary.overlap_size_tokens // chunker_summary.chunk_size_tokens
+            return chunker_summary.create_token_chunks(data, chunk_tokens, overlap_tokens)
+        return chunker_summary.create_chunks(data)
+
+    if chunk_tokens > 0:
+        chunk_params = {"chunk_size_tokens": chunk_tokens, "chars_per_token": chunker_summary.chars_per_token}
+    else:
+        chunk_params = {
+            "chunk_size_words": chunker_summary.chunk_size_words,
+            "overlap_size_words": chunker_summary.overlap_size_words,
+        }
+
+    # Helper function to create chunks and summarize them as a single stage
+    def build_chunks(data):
+        return chunker_summary.summarize_chunks(make_chunks(data))
+
+    # Helper function to create chunks and analyze them as a single stage
+    def build_analysis(data):
+        return chunk_analysis.analyze_chunks(make_chunks(data))
+
+    if fused:
+        (chunks, characters), chunks_key = run_stage('chunk analysis', [transcript_key], {
+            **chunk_params,
+            "model": chunk_analysis.model_name,
+        }, build_analysis, transcript)
+        characters_key = chunks_key
+    else:
+        chunks, chunks_key = run_stage('chunks', [transcript_key], {
+            **chunk_params,
+            "model": chunker_summary.model_name,
+        }, build_chunks, transcript)
+        if batch_tokens > 0:
+            characters, characters_key = run_stage('characters', [chunks_key], {
+                "model": extract_characters.model_name,
+                "batch_tokens": batch_tokens,
+            }, extract_characters.extract_chunk_characters_batched, chunks, batch_tokens)
+        else:
+            characters, characters_key = run_stage('characters', [chunks_key], {
+                "model": extract_characters.model_name,
+            }, extract_characters.extract_chunk_characters, chunks)
+    save_debug('chunks.json', chunks)
+    save_debug('cumulative_characters.json', characters)
+    characters, characters_key = run_stage('character names', [characters_key], {
+        "model": extract_characters.model_name,
+    }, extract_characters.refine_character_names, characters)
+    save_debug('characters.json', characters)
+
+    # merge_characters_chunks.py is skipped: merge_events_chunks.py rewrites its output with the same fields plus "important"
+    important_chunks, events_key = run_stage('events', [chunks_key], {
+        "model": extract_events.model_name,
+        "selection_mode": extract_events.selection_mode,
+        "max_prompt_tokens": extract_events.max_prompt_tokens,
+        "window_chunks": extract_events.window_chunks,
+        "candidates_per_window": extract_events.candidates_per_window,
+    }, extract_events.find_important_chunks, chunks)
+    if important_chunks is None:
+        raise RuntimeError("Could not identify the important chunks.")
+    save_debug('important_chunks.json', important_chunks)
+
+    # Characters and importance are attached in place to compact records of the chunks
+    merged_data, merged_key = run_stage('merge', [chunks_key, characters_key, events_key], {},
+                                        merge_events_chunks.merge_events, ChunkStore.from_dicts(chunks),
+                                        characters, important_chunks, cached=False)
+    if debug:
+        save_debug('merged_chunks.json', merged_data.to_dicts())
+
+    results, results_key = run_stage('results', [merged_key], {},
+                                     results_generator.generate_results, merged_data)
+    save_debug('results.json', results)
+
+    filtered_results, filtered_key = run_stage('refine', [results_key], {
+        "embedding_model": results_refiner.embedding_model_key(),
+        "similarity_threshold": results_refiner.similarity_threshold,
+        "min_contexts": results_refiner.min_contexts,
+    }, results_refiner.refine_results, results)
+    save_debug('filtered_results.json', filtered_results)
+
+    output, output_key = run_stage('character summaries', [filtered_key], {
+        "model": character_summary.model_name,
+        "summary_mode": character_summary.summary_mode,
+        "max_prompt_tokens": character_summary.max_prompt_tokens,
+        "section_tokens": character_summary.section_tokens,
+    }, character_summary.summarize_characters, filtered_results)
+
+    if timelines:
+        output, _ = run_stage('character timelines', [output_key], {
+            "model": character_timeline.model_name,
+            "sentiment_window_pages": character_timeline.sentiment_window_pages,
+            "max_checkpoints": character_timeline.max_checkpoints,
+            "personality_batch_tokens": character_timeline.personality_batch_tokens,
+        }, character_timeline.build_timelines, output)
+
+    # Write to a temporary file first, so readers of out/ never see a partial story
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    if output_path.endswith(story_store.story_extension):
+        story_store.write_story(output, output_path)
+    else:
+        with open(output_path + '.tmp', 'w') as outfile:
+            json.dump(output, outfile, indent=4)
+        os.replace(output_path + '.tmp', output_path)
+
+    print(f"Character summaries saved to '{output_path}'.")
+
+    # The story is already saved, so a failure here does not fail the run; the server
+    # builds a missing index when it is first needed
+    if build_index:
+        try:
+            run_stage('context index', [], {}, context_index.build_context_index,
+                      output, context_index.index_dir(output_path), cached=False)
+        except Exception as err:
+            print(f"Could not build the context index: {err}")
+    return output
+
+
+# Load the transcript for the requested source, read from input_path or else input.pdf or
+# input.txt in temp_dir (default temp/). Returns the transcript and a key identifying its content.
+def load_source(source, workers=1, cache=None, input_path=None, temp_dir=None):
+    temp_dir = temp_dir or workspace.default_workspace
+    if source == 'transcript':
+        transcript = chunker_summary.load_transcript(temp_dir)
+        return transcript, hash_json(transcript)
+
+    if input_path is None:
+        input_path = os.path.join(temp_dir, 'input.pdf' if source == 'pdf' else 'input.txt')
+    key = hash_file(input_path)
+    if cache is not None:
+        key = cache.key('transcript', [key], {"source": source})
+        transcript = cache.get(key)
+        if transcript is not None:
+            print("Stage 'transcript' loaded from cache.")
+            return transcript, key
+
+    print("Stage 'transcript' started.")
+    start = time.perf_counter()
+    if source == 'pdf':
+        transcript = list(pdf_to_text.iter_pages(input_path, workers))
+    else:
+        with open(input_path, 'r') as file:
+            transcript = list(txt_to_transcript.iter_pages(file))
+    print(f"Stage 'transcript' finished in {time.perf_counter() - start:.2f}s.")
+
+    if cache is not None:
+        cache.put(key, transcript)
+    return transcript, key
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the whole parsing pipeline in a single process.")
+    parser.add_argument('--source', choices=['pdf', 'txt', 'transcript'], default='transcript',
+                        help="Start from input.pdf, input.txt or an existing transcript in the workspace (default).")
+    parser.add_argument('--input',
+                        help="With --source pdf or txt, read this file instead of the workspace's input.pdf or input.txt.")
+    workspace.add_argument(parser)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of PDF extraction processes (0 = one per CPU, default 1).")
+    parser.add_argument('--output', default=os.path.join(PROJECT_ROOT, 'out', 'output.json'),
+                        help="Where to write the final story; a .story path writes the SQLite story format.")
+    parser.add_argument('--debug', action='store_true',
+                        help="Write every intermediate result to the workspace like the stage scripts do.")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Recompute every stage instead of reusing cached outputs.")
+    parser.add_argument('--fused', action='store_true',
+                        help="Opt in to summarizing each chunk and extracting its characters with one request "
+                             "(default: separate summary and character requests).")
+    parser.add_argument('--chunk-tokens', type=int, default=0,
+                        help="Build sentence-aligned chunks of about this many tokens instead of 500-word windows.")
+    parser.add_argument('--no-timelines', action='store_true',
+                        help="Skip precomputing the personality and sentiment timelines used by the chatbot.")
+    parser.add_argument('--context-index', action='store_true',
+                        help="Embed the contexts for the chatbot's retrieval mode (CHAT_CONTEXT_MODE=retrieval).")
+    parser.add_argument('--batch-tokens', type=int, default=0,
+                        help="Without --fused, pack chunks into character requests of about this many prompt tokens.")
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else StageCache()
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    transcript, transcript_key = load_source(args.source, workers, cache, args.input, args.workspace)
+    if args.debug and args.source != 'transcript':
+        temp_dir = args.workspace
+        os.makedirs(temp_dir, exist_ok=True)
+        if os.path.exists(os.path.join(temp_dir, 'transcript.jsonl')):
+            os.remove(os.path.join(temp_dir, 'transcript.jsonl'))
+        with open(os.path.join(temp_dir, 'transcript.json'), 'w') as outfile:
+            json.dump(transcript, outfile, indent=4)
+
+    run_pipeline(transcript, args.output, debug=args.debug, cache=cache, transcript_key=transcript_key,
+                 fused=args.fused, batch_tokens=args.batch_tokens, chunk_tokens=args.chunk_tokens,
+                 temp_dir=args.workspace, timelines=not args.no_timelines,
+                 build_index=args.context_index)
+
+
+if __name__ == '__main__':
+    main()
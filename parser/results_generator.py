@@ -1,82 +1,102 @@
 import json
 import uuid
 import os
+import workspace
 
 # Get project root directory
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-# Load the merged chunks data
-temp_dir = os.path.join(PROJECT_ROOT, 'temp')
-with open(os.path.join(temp_dir, 'merged_chunks.json'), 'r') as infile:
-    merged_data = json.load(infile)
-
-# Initialize dictionaries for characters and contexts
-characters_dict = {}
-contexts_dict = {}
-
-# Helper function to generate a unique ID
-def generate_uid():
-    return str(uuid.uuid4())
-
-# Process each chunk to build the characters and contexts dictionaries
-for chunk in merged_data:
-    # Generate a unique ID for the context
-    context_id = generate_uid()
-    
-    # Add the context to the contexts dictionary
-    contexts_dict[context_id] = {
-        "id": context_id,
-        "chunk_num": chunk["chunk_num"],
-        "page_nums": chunk["page_nums"],
-        "text": chunk["text"],
-        "summary": chunk['summary'],
-        "characters": chunk["characters"],
-        "important": chunk["important"]
+
+# Namespace for the content-derived IDs, so the same input always gets the same IDs
+ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'chronicle')
+
+
+# Helper function to derive a context's ID from its text. occurrence tells apart
+# chunks with identical text.
+def context_uid(text, occurrence=0):
+    return str(uuid.uuid5(ID_NAMESPACE, f"context:{occurrence}:{text}"))
+
+
+# Helper function to derive a character's ID from its name
+def character_uid(name):
+    return str(uuid.uuid5(ID_NAMESPACE, f"character:{name}"))
+
+
+# Build the characters and contexts dictionaries from the merged chunks
+def generate_results(merged_data):
+    # Initialize dictionaries for characters and contexts
+    characters_dict = {}
+    contexts_dict = {}
+    name_to_id = {}  # Character name -> ID in characters_dict
+    text_occurrences = {}  # Chunk text -> number of chunks seen with that text
+
+    # Process each chunk to build the characters and contexts dictionaries
+    for chunk in merged_data:
+        # Derive the context's ID from its content
+        occurrence = text_occurrences.get(chunk["text"], 0)
+        text_occurrences[chunk["text"]] = occurrence + 1
+        context_id = context_uid(chunk["text"], occurrence)
+
+        # Add the context to the contexts dictionary
+        contexts_dict[context_id] = {
+            "id": context_id,
+            "chunk_num": chunk["chunk_num"],
+            "page_nums": chunk["page_nums"],
+            "text": chunk["text"],
+            "summary": chunk['summary'],
+            "characters": chunk["characters"],
+            "important": chunk["important"]
+        }
+
+        # Process each character in the chunk
+        for character_name in chunk["characters"]:
+            # Check if the character already exists in the characters dictionary
+            character_found = name_to_id.get(character_name)
+
+            # If the character doesn't exist, create a new entry
+            if not character_found:
+                character_id = character_uid(character_name)
+                name_to_id[character_name] = character_id
+                characters_dict[character_id] = {
+                    "id": character_id,
+                    "name": character_name,
+                    "contexts": [context_id]  # Add the current context ID
+                }
+            else:
+                # If the character exists, add the current context ID to their contexts list
+                characters_dict[character_found]["contexts"].append(context_id)
+
+    # Sort characters by the number of contexts they appear in (descending order)
+    sorted_characters = sorted(
+        characters_dict.items(),
+        key=lambda item: len(item[1]["contexts"]),
+        reverse=True
+    )
+
+    # Convert the sorted list back into a dictionary
+    sorted_characters_dict = {item[0]: item[1] for item in sorted_characters}
+
+    # Combine the results into the final structure
+    return {
+        "characters": sorted_characters_dict,
+        "contexts": contexts_dict
     }
-    
-    # Process each character in the chunk
-    for character_name in chunk["characters"]:
-        # Check if the character already exists in the characters dictionary
-        character_found = None
-        for uid, character_data in characters_dict.items():
-            if character_data["name"] == character_name:
-                character_found = uid
-                break
-        
-        # If the character doesn't exist, create a new entry
-        if not character_found:
-            character_id = generate_uid()
-            characters_dict[character_id] = {
-                "id": character_id,
-                "name": character_name,
-                "contexts": [context_id]  # Add the current context ID
-            }
-        else:
-            # If the character exists, add the current context ID to their contexts list
-            characters_dict[character_found]["contexts"].append(context_id)
-
-# Sort characters by the number of contexts they appear in (descending order)
-sorted_characters = sorted(
-    characters_dict.items(),
-    key=lambda item: len(item[1]["contexts"]),
-    reverse=True
-)
-
-# Convert the sorted list back into a dictionary
-sorted_characters_dict = {item[0]: item[1] for item in sorted_characters}
-
-# Combine the results into the final structure
-results = {
-    "characters": sorted_characters_dict,
-    "contexts": contexts_dict
-}
-
-# Ensure out directory exists
-temp_dir = os.path.join(PROJECT_ROOT, 'temp')
-os.makedirs(temp_dir, exist_ok=True)
-
-# Save the results to a new JSON file
-with open(os.path.join(temp_dir, 'results.json'), 'w') as outfile:
-    json.dump(results, outfile, indent=4)
-
-print("Results saved to 'results.json'.")
+
+
+def main():
+    # Load the merged chunks data
+    temp_dir = workspace.parse_workspace("Build the characters and contexts dictionaries from merged_chunks.json.")
+    with open(os.path.join(temp_dir, 'merged_chunks.json'), 'r') as infile:
+        merged_data = json.load(infile)
+
+    results = generate_results(merged_data)
+
+    # Save the results to a new JSON file
+    with open(os.path.join(temp_dir, 'results.json'), 'w') as outfile:
+        json.dump(results, outfile, indent=4)
+
+    print("Results saved to 'results.json'.")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,68 +1,130 @@
 import json
 import os
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
+import numpy as np
+import embedding_cache
+import workspace
 
 # Get project root directory
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-# Load the results data
-with open(os.path.join(PROJECT_ROOT, 'temp', 'results.json'), 'r') as infile:
-    results = json.load(infile)
-
-# Initialize the Sentence-BERT model for name vectorization
-model = SentenceTransformer('paraphrase-MiniLM-L6-v2')
-
-# Helper function to convert names into vectors
-def get_name_vector(name):
-    return model.encode([name])[0]  # Return the vector for the name
-
-# Helper function to calculate cosine similarity between two vectors
-def cosine_sim(v1, v2):
-    return cosine_similarity([v1], [v2])[0][0]
+# Configuration parameters
+embedding_model_name = 'paraphrase-MiniLM-L6-v2'  # Sentence-BERT model used to compare names
+embedding_backend = os.getenv("EMBEDDING_BACKEND", "torch")  # 'torch' (sentence-transformers) or 'onnx' (onnxruntime)
+onnx_model_file = os.getenv("EMBEDDING_ONNX_FILE", "onnx/model_quint8_avx2.onnx")  # ONNX export used by the 'onnx' backend
+similarity_threshold = 0.9  # Minimum cosine similarity for two names to be grouped
+min_contexts = 5  # Characters appearing in fewer contexts are dropped
+similarity_block_rows = 1024  # Rows of the similarity matrix computed at a time
+
+# Sentence-BERT model for name vectorization and its on-disk name embeddings, loaded on first use
+model = None
+name_cache = None
+
+
+# Identifies the model and backend, since the int8 ONNX export gives slightly different vectors
+def embedding_model_key():
+    if embedding_backend == 'onnx':
+        return f"{embedding_model_name}@{onnx_model_file}"
+    return embedding_model_name
+
+
+# Helper function to load the model once per process. The backends are imported here,
+# so runs where every name is already cached never import torch or onnxruntime.
+def get_model():
+    global model
+    if model is None:
+        if embedding_backend == 'onnx':
+            from onnx_embedder import OnnxEmbedder
+            model = OnnxEmbedder(embedding_model_name, onnx_model_file)
+        elif embedding_backend == 'torch':
+            from sentence_transformers import SentenceTransformer
+            model = SentenceTransformer(embedding_model_name)
+        else:
+            raise ValueError(f"Unknown embedding backend '{embedding_backend}'.")
+    return model
+
+
+# Helper function to open the name embedding cache once per process
+def get_name_cache():
+    global name_cache
+    if name_cache is None:
+        name_cache = embedding_cache.EmbeddingCache(embedding_model_key())
+    return name_cache
+
+
+# Helper function to convert names into unit-length vectors. Names seen in earlier runs come
+# from the embedding cache; the rest are embedded with one batched model call.
+def get_name_vectors(names):
+    if embedding_cache.cache_enabled:
+        vectors = get_name_cache().encode(names, lambda missing: get_model().encode(missing, batch_size=256))
+    else:
+        vectors = get_model().encode(names, batch_size=256)
+    return normalize_vectors(vectors)
+
+# Helper function to scale vectors to unit length
+def normalize_vectors(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1  # Leave zero vectors as they are, like sklearn's cosine_similarity
+    return vectors / norms
 
 # Helper function to find the most specific name in a group
 def find_most_specific_name(names):
     return max(names, key=lambda name: (len(name.split()), len(name)))  # Prefer longer names
 
-# Adjusted function to group similar character names
-def group_similar_characters(characters_dict, similarity_threshold=0.9):
+# Helper function to find, for every name, the later names at least similarity_threshold similar to it.
+# Similarities are computed as normalized matrix products over blocks of rows, so memory
+# stays at block_rows x n plus the (few) similar pairs.
+def find_similar_pairs(vectors, similarity_threshold, block_rows=similarity_block_rows):
+    total = len(vectors)
+    columns = np.arange(total)
+    similar = {}
+    for block_start in range(0, total, block_rows):
+        rows = np.arange(block_start, min(block_start + block_rows, total))
+        similarities = vectors[rows] @ vectors.T
+        # Only pairs (i, j) with j > i, as the greedy grouping below only looks forward
+        mask = (similarities >= similarity_threshold) & (columns[None, :] > rows[:, None])
+        for row, column in zip(*np.nonzero(mask)):
+            similar.setdefault(int(rows[row]), []).append((int(column), float(similarities[row, column])))
+    return similar
+
+# Adjusted function to group similar character names. Each name not yet grouped starts a
+# group and takes every later, ungrouped name that is similar to it and is not a substring
+# of it (or the other way around).
+def group_similar_characters(characters_dict, similarity_threshold=similarity_threshold):
     grouped_characters = []
     character_ids = list(characters_dict.keys())
     total_ids = len(character_ids)
     
     print(f"Starting to group {total_ids} characters...")
+    if not character_ids:
+        print("Finished grouping characters.")
+        return grouped_characters
     
-    name_vectors = {id: get_name_vector(characters_dict[id]["name"]) for id in character_ids}
-    visited = set()
+    names = [characters_dict[id]["name"] for id in character_ids]
+    similar = find_similar_pairs(get_name_vectors(names), similarity_threshold)
+    visited = np.zeros(total_ids, dtype=bool)
     
     for i, id1 in enumerate(character_ids):
-        if id1 in visited:
+        if visited[i]:
             continue  # Skip if already grouped
         
-        name1 = characters_dict[id1]["name"]
+        name1 = names[i]
         group = [id1]
-        vector1 = name_vectors[id1]
-        visited.add(id1)
+        visited[i] = True
         
-        for j in range(i + 1, len(character_ids)):
-            id2 = character_ids[j]
-            if id2 in visited:
+        for j, similarity in similar.get(i, ()):
+            if visited[j]:
                 continue  # Skip if already grouped
             
-            name2 = characters_dict[id2]["name"]
+            name2 = names[j]
             
             # Skip if one name is a substring of the other
             if name1 in name2 or name2 in name1:
                 continue  # Do not group
             
-            vector2 = name_vectors[id2]
-            similarity = cosine_sim(vector1, vector2)
-            
-            if similarity >= similarity_threshold:
-                print(f"    Names '{name1}' and '{name2}' are similar (similarity: {similarity:.2f}). Grouping them.")
-                group.append(id2)
-                visited.add(id2)
+            print(f"    Names '{name1}' and '{name2}' are similar (similarity: {similarity:.2f}). Grouping them.")
+            group.append(character_ids[j])
+            visited[j] = True
         
         grouped_characters.append(group)
         print(f"  Group for '{name1}': {group}")
@@ -70,94 +132,106 @@ def group_similar_characters(characters_dict, similarity_threshold=0.9):
     print("Finished grouping characters.")
     return grouped_characters
 
-# Group similar character names
-print("Starting character refinement...")
-grouped_characters = group_similar_characters(results["characters"])
-
-# Create a mapping from original IDs to a canonical name
-name_mapping = {}
-for group in grouped_characters:
-    # Find the most specific name in the group
-    canonical_id = max(group, key=lambda id: (len(results["characters"][id]["name"].split()), len(results["characters"][id]["name"])))
-    canonical_name = results["characters"][canonical_id]["name"]
-    print(f"  Group for '{canonical_name}': {group}")
-    
-    for char_id in group:
-        name_mapping[char_id] = canonical_id
 
-print("Created name mapping for canonical names.")
+# Merge similar characters, drop minor ones and update the contexts to match
+def refine_results(results):
+    # Group similar character names
+    print("Starting character refinement...")
+    grouped_characters = group_similar_characters(results["characters"])
+
+    # Create mappings from original IDs to a canonical ID and from every name to its canonical name
+    canonical_ids = []
+    name_mapping = {}
+    alias_to_canonical = {}
+    for group in grouped_characters:
+        # Find the most specific name in the group
+        canonical_id = max(group, key=lambda id: (len(results["characters"][id]["name"].split()), len(results["characters"][id]["name"])))
+        canonical_name = results["characters"][canonical_id]["name"]
+        canonical_ids.append(canonical_id)
+        print(f"  Group for '{canonical_name}': {group}")
+        
+        for char_id in group:
+            name_mapping[char_id] = canonical_id
+            alias_to_canonical[results["characters"][char_id]["name"]] = canonical_name
 
-# Merge contexts for similar characters
-refined_characters = {}
-for group in grouped_characters:
-    canonical_id = max(group, key=lambda id: (len(results["characters"][id]["name"].split()), len(results["characters"][id]["name"])))
-    canonical_name = results["characters"][canonical_id]["name"]
-    merged_contexts = []
-    
-    for char_id in group:
-        if char_id in results["characters"]:
-            merged_contexts.extend(results["characters"][char_id]["contexts"])
-    
-    # Remove duplicate contexts
-    merged_contexts = list(set(merged_contexts))
-    
-    # Add the canonical character to the refined characters dictionary
-    refined_characters[canonical_id] = {
-        "id": canonical_id,
-        "name": canonical_name,
-        "contexts": merged_contexts
+    print("Created name mapping for canonical names.")
+
+    # Merge contexts for similar characters
+    refined_characters = {}
+    for group, canonical_id in zip(grouped_characters, canonical_ids):
+        canonical_name = results["characters"][canonical_id]["name"]
+        merged_contexts = []
+        
+        for char_id in group:
+            if char_id in results["characters"]:
+                merged_contexts.extend(results["characters"][char_id]["contexts"])
+        
+        # Remove duplicate contexts, keeping the order they appear in
+        merged_contexts = list(dict.fromkeys(merged_contexts))
+        
+        # Add the canonical character to the refined characters dictionary
+        refined_characters[canonical_id] = {
+            "id": canonical_id,
+            "name": canonical_name,
+            "contexts": merged_contexts
+        }
+
+    print("Merged contexts for similar characters.")
+
+    # Filter out characters with fewer than min_contexts contexts
+    filtered_characters = {
+        char_id: char_data
+        for char_id, char_data in refined_characters.items()
+        if len(char_data["contexts"]) >= min_contexts
     }
 
-print("Merged contexts for similar characters.")
-
-# Filter out characters with fewer than 5 contexts
-filtered_characters = {
-    char_id: char_data
-    for char_id, char_data in refined_characters.items()
-    if len(char_data["contexts"]) >= 5
-}
-
-print(f"Filtered out characters with fewer than 5 contexts. Remaining characters: {len(filtered_characters)}")
-
-# Update contexts to reflect the filtered characters
-filtered_contexts = {}
-for context_id, context_data in results["contexts"].items():
-    filtered_characters_list = [
-        char_name
-        for char_name in context_data["characters"]
-        if any(
-            char_name == char_data["name"]
-            for char_data in filtered_characters.values()
-        )
-    ]
-    
-    # Remove duplicate characters
-    filtered_characters_list = list(set(filtered_characters_list))
-    
-    filtered_contexts[context_id] = {
-        "id": context_data["id"],
-        "chunk_num": context_data["chunk_num"],
-        "page_nums": context_data["page_nums"],
-        "text": context_data["text"],
-        "summary": context_data['summary'],
-        "characters": filtered_characters_list,
-        "important": context_data["important"]
+    print(f"Filtered out characters with fewer than {min_contexts} contexts. Remaining characters: {len(filtered_characters)}")
+
+    # Update contexts to reflect the filtered characters, replacing merged aliases with their canonical name
+    kept_names = {char_data["name"] for char_data in filtered_characters.values()}
+    filtered_contexts = {}
+    for context_id, context_data in results["contexts"].items():
+        canonical_names = (alias_to_canonical.get(char_name, char_name) for char_name in context_data["characters"])
+        
+        # Remove duplicate characters, keeping the order they appear in
+        filtered_characters_list = list(dict.fromkeys(
+            char_name for char_name in canonical_names if char_name in kept_names
+        ))
+        
+        filtered_contexts[context_id] = {
+            "id": context_data["id"],
+            "chunk_num": context_data["chunk_num"],
+            "page_nums": context_data["page_nums"],
+            "text": context_data["text"],
+            "summary": context_data['summary'],
+            "characters": filtered_characters_list,
+            "important": context_data["important"]
+        }
+
+    print("Updated contexts to reflect filtered characters.")
+
+    # Combine the filtered results
+    return {
+        "characters": filtered_characters,
+        "contexts": filtered_contexts
     }
 
-print("Updated contexts to reflect filtered characters.")
 
-# Combine the filtered results
-filtered_results = {
-    "characters": filtered_characters,
-    "contexts": filtered_contexts
-}
+def main():
+    temp_dir = workspace.parse_workspace("Merge similar characters in results.json and drop minor ones.")
+
+    # Load the results data
+    with open(os.path.join(temp_dir, 'results.json'), 'r') as infile:
+        results = json.load(infile)
+
+    filtered_results = refine_results(results)
+
+    # Save the filtered results to a new JSON file
+    with open(os.path.join(temp_dir, 'filtered_results.json'), 'w') as outfile:
+        json.dump(filtered_results, outfile, indent=4)
 
-# Ensure out directory exists
-temp_dir = os.path.join(PROJECT_ROOT, 'temp')
-os.makedirs(temp_dir, exist_ok=True)
+    print(f"Filtered results saved to 'filtered_results.json'.")
 
-# Save the filtered results to a new JSON file
-with open(os.path.join(temp_dir, 'filtered_results.json'), 'w') as outfile:
-    json.dump(filtered_results, outfile, indent=4)
 
-print(f"Filtered results saved to 'filtered_results.json'.")
+if __name__ == '__main__':
+    main()
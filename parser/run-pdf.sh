@@ -1 +1 @@
-python pdf_to_text.py && ./run.sh
+python pipeline.py --source pdf --workers 0
\ No newline at end of file
@@ -1 +1 @@
-python txt_to_transcript.py && ./run.sh
+python pipeline.py --source txt
\ No newline at end of file
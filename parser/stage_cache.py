@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import tempfile
+
+# Get project root directory
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Configuration parameters
+cache_dir = os.path.join(PROJECT_ROOT, 'cache', 'stages')  # Where stage outputs are stored
+max_cache_bytes = int(os.getenv("STAGE_CACHE_MAX_BYTES", 1 << 30))  # Size cap before old entries are evicted
+cache_version = 2  # Bump when a stage's output format changes to invalidate old entries
+
+
+# Helper function to hash a file's contents
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Helper function to hash JSON-serializable data
+def hash_json(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# Stage outputs stored on disk under a key derived from the stage name, the keys
+# of its inputs and its parameters. Entries are evicted least recently used first
+# once the directory grows past max_bytes.
+class StageCache:
+    def __init__(self, directory=cache_dir, max_bytes=max_cache_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    # Key for a stage given the keys of its inputs and its parameters
+    def key(self, stage, input_keys, params=None):
+        return hash_json({
+            "version": cache_version,
+            "stage": stage,
+            "inputs": list(input_keys),
+            "params": params or {},
+        })
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    # Return the stored output for key, or None if it is not cached
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r') as infile:
+                value = json.load(infile)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        # Mark the entry as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    # Store the output for key and evict old entries if the cache is over its size cap
+    def put(self, key, value):
+        # Write to a temporary file first so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as outfile:
+            json.dump(value, outfile)
+        os.replace(tmp_path, self._path(key))
+        self.evict()
+
+    # Remove least recently used entries until the cache fits in max_bytes
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+
+        entries.sort()
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                print(f"Evicted stage cache entry '{name}'.")
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,286 @@
+import argparse
+import glob
+import json
+import os
+import sqlite3
+import sys
+import threading
+import zlib
+from array import array
+
+# Stories in a single SQLite file (.story) instead of indented JSON. Characters and contexts
+# get integer ids in story order, so a character's contexts are a packed array of ints instead
+# of a list of UUID strings. Context texts are stored compressed in their own table and only
+# read when asked for, so listing characters and summaries never touches them.
+
+# Get project root directory
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Configuration parameters
+story_extension = '.story'
+format_version = 1
+
+schema = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE characters (
+    id INTEGER PRIMARY KEY, uid TEXT NOT NULL, name TEXT NOT NULL, summary TEXT,
+    contexts BLOB NOT NULL, extra TEXT
+);
+CREATE TABLE contexts (
+    id INTEGER PRIMARY KEY, uid TEXT NOT NULL, chunk_num INTEGER, page_nums TEXT NOT NULL,
+    summary TEXT, characters TEXT NOT NULL, important INTEGER, extra TEXT
+);
+CREATE TABLE texts (context_id INTEGER PRIMARY KEY, text BLOB NOT NULL);
+"""
+
+# Fields with their own columns; any others are kept as JSON in the extra column
+character_fields = ('id', 'name', 'summary', 'contexts')
+context_fields = ('id', 'chunk_num', 'page_nums', 'text', 'summary', 'characters', 'important')
+
+
+# Helper function to pack a list of ints into a blob
+def pack_ids(ids):
+    return array('I', ids).tobytes()
+
+
+# Helper function to unpack a blob written by pack_ids
+def unpack_ids(blob):
+    ids = array('I')
+    ids.frombytes(blob)
+    return ids.tolist()
+
+
+# Helper function to serialize the fields of record not in fields, or None if there are none
+def extra_fields(record, fields):
+    extra = {key: value for key, value in record.items() if key not in fields}
+    return json.dumps(extra) if extra else None
+
+
+# Write a story dict (the out/*.json structure) to a .story file at path
+def write_story(story, path):
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.executescript(schema)
+        conn.execute("INSERT INTO meta VALUES ('format_version', ?)", (str(format_version),))
+
+        context_ids = {}
+        for context_id, (uid, context) in enumerate(story["contexts"].items()):
+            context_ids[uid] = context_id
+            conn.execute(
+                "INSERT INTO contexts VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (context_id, uid, context.get("chunk_num"), json.dumps(context.get("page_nums", [])),
+                 context.get("summary"), json.dumps(context.get("characters", [])),
+                 None if context.get("important") is None else int(context["important"]),
+                 extra_fields(context, context_fields)),
+            )
+            conn.execute("INSERT INTO texts VALUES (?, ?)",
+                         (context_id, zlib.compress(context.get("text", "").encode('utf-8'))))
+
+        for character_id, (uid, character) in enumerate(story["characters"].items()):
+            known = [context_ids[context] for context in character.get("contexts", []) if context in context_ids]
+            if len(known) < len(character.get("contexts", [])):
+                print(f"Dropping {len(character['contexts']) - len(known)} unknown contexts of '{character['name']}'.")
+            conn.execute(
+                "INSERT INTO characters VALUES (?, ?, ?, ?, ?, ?)",
+                (character_id, uid, character["name"], character.get("summary"), pack_ids(known),
+                 extra_fields(character, character_fields)),
+            )
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+
+
+# Read access to a .story file. Characters and context metadata are read once on open;
+# texts are read per context on demand.
+class StoryStore:
+    def __init__(self, path):
+        self.path = path
+        # Read-only, and shared by the server's request threads, one query at a time
+        self.conn = self._connect()
+        self.lock = threading.Lock()
+        version = int(self.conn.execute("SELECT value FROM meta WHERE key = 'format_version'").fetchone()[0])
+        if version != format_version:
+            raise ValueError(f"Unsupported story format version {version} in '{path}'.")
+
+        self.context_uids = []  # Integer context id -> context UID
+        self.context_ids = {}  # Context UID -> integer context id
+        self.contexts = {}  # Context UID -> context dict without its text
+        for row in self.conn.execute("SELECT * FROM contexts ORDER BY id"):
+            context_id, uid, chunk_num, page_nums, summary, characters, important, extra = row
+            context = {
+                "id": uid,
+                "chunk_num": chunk_num,
+                "page_nums": json.loads(page_nums),
+                "summary": summary,
+                "characters": json.loads(characters),
+                "important": None if important is None else bool(important),
+            }
+            if extra:
+                context.update(json.loads(extra))
+            self.context_uids.append(uid)
+            self.context_ids[uid] = context_id
+            self.contexts[uid] = context
+
+        self.characters = {}  # Character UID -> character dict, with context UIDs like the JSON format
+        self.character_context_ids = {}  # Character UID -> integer context ids
+        for row in self.conn.execute("SELECT * FROM characters ORDER BY id"):
+            _, uid, name, summary, contexts, extra = row
+            context_ids = unpack_ids(contexts)
+            character = {
+                "id": uid,
+                "name": name,
+                "contexts": [self.context_uids[context_id] for context_id in context_ids],
+                "summary": summary,
+            }
+            if extra:
+                character.update(json.loads(extra))
+            self.characters[uid] = character
+            self.character_context_ids[uid] = context_ids
+
+    def _connect(self):
+        return sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+
+    # Return the text of the context with the given UID. Reopens the file if the store was closed
+    # while its story was still in use.
+    def text(self, context_uid):
+        with self.lock:
+            if self.conn is None:
+                self.conn = self._connect()
+            row = self.conn.execute(
+                "SELECT text FROM texts WHERE context_id = ?", (self.context_ids[context_uid],)
+            ).fetchone()
+        return zlib.decompress(row[0]).decode('utf-8')
+
+    # Close the file; it is opened again if another text is asked for
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+# Context dict that reads its text from the store the first time it is used. Looking up
+# other keys never reads it; anything that sees the whole dict (iteration, items(), "in",
+# get, dict(), json.dumps) reads it first, so the context looks like its JSON counterpart.
+class LazyContext(dict):
+    def __init__(self, store, uid, fields):
+        super().__init__(fields)
+        self.store = store
+        self.uid = uid
+
+    # Helper function to read the text into the dict if it is not there yet, after page_nums
+    # where the JSON format has it
+    def _load(self):
+        if super().__contains__("text"):
+            return
+        fields = list(super().items())
+        super().clear()
+        for key, value in fields:
+            self[key] = value
+            if key == "page_nums":
+                self["text"] = self.store.text(self.uid)
+        if not super().__contains__("text"):
+            self["text"] = self.store.text(self.uid)
+
+    def __missing__(self, key):
+        if key != "text":
+            raise KeyError(key)
+        self._load()
+        return self["text"]
+
+    def __contains__(self, key):
+        return key == "text" or super().__contains__(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __iter__(self):
+        self._load()
+        return super().__iter__()
+
+    def __len__(self):
+        self._load()
+        return super().__len__()
+
+    def keys(self):
+        self._load()
+        return super().keys()
+
+    def items(self):
+        self._load()
+        return super().items()
+
+    def values(self):
+        self._load()
+        return super().values()
+
+    def copy(self):
+        self._load()
+        return dict(self)
+
+
+# Open a .story file as the out/*.json structure without reading any context text up
+# front; context["text"] is read when first used. Returns the story and its store, which
+# the caller closes once it is done with the story.
+def open_story(path):
+    store = StoryStore(path)
+    contexts = {uid: LazyContext(store, uid, context) for uid, context in store.contexts.items()}
+    return {"characters": store.characters, "contexts": contexts}, store
+
+
+# Like open_story, for callers that keep the story for the life of the process
+def load_story(path):
+    return open_story(path)[0]
+
+
+# Read a .story file back into the out/*.json structure, with each context's text included
+def read_story(path):
+    store = StoryStore(path)
+    try:
+        contexts = {}
+        for uid, context in store.contexts.items():
+            # Put the text back where the JSON format has it, after page_nums
+            contexts[uid] = {}
+            for key, value in context.items():
+                contexts[uid][key] = value
+                if key == "page_nums":
+                    contexts[uid]["text"] = store.text(uid)
+        return {"characters": store.characters, "contexts": contexts}
+    finally:
+        store.close()
+
+
+# Convert a JSON story to a .story file next to it (or at out_path). Returns the new path.
+def convert_json(json_path, out_path=None):
+    out_path = out_path or os.path.splitext(json_path)[0] + story_extension
+    with open(json_path, 'r') as infile:
+        story = json.load(infile)
+    write_story(story, out_path)
+    return out_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert JSON stories to .story files, or back with --to-json.")
+    parser.add_argument('paths', nargs='*', help="Files to convert (default: every out/*.json).")
+    parser.add_argument('--to-json', action='store_true', help="Convert .story files back to indented JSON.")
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(glob.glob(os.path.join(PROJECT_ROOT, 'out', '*.json')))
+    for path in paths:
+        if args.to_json:
+            out_path = os.path.splitext(path)[0] + '.json'
+            with open(out_path, 'w') as outfile:
+                json.dump(read_story(path), outfile, indent=4)
+        else:
+            out_path = convert_json(path)
+        print(f"Converted '{path}' to '{out_path}' ({os.path.getsize(path)} -> {os.path.getsize(out_path)} bytes).")
+    if not paths:
+        print("No stories to convert.", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,92 @@
 import json
 import os
+import sys
+import argparse
+import workspace
 
 # Get project root directory
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-text_data = []
-# Read the input file
-with open(PROJECT_ROOT + '/temp/input.txt', 'r') as file:
-    text = file.read()
+# Configuration parameters
+words_per_page = 500  # Number of words per transcript page
+read_size_chars = 1 << 20  # Characters read from the input file at a time
 
-    # Split text into words
-    words = text.split()
 
-    # Initialize variables
+# Yield the words of a text file without loading the whole file into memory.
+# Splits exactly like str.split() on the full text would.
+def iter_words(file, read_size=read_size_chars):
+    carry = ''
+    while True:
+        block = file.read(read_size)
+        if not block:
+            break
+        block = carry + block
+        words = block.split()
+        # A word running into the end of the block may continue in the next one
+        if words and not block[-1].isspace():
+            carry = words.pop()
+        else:
+            carry = ''
+        for word in words:
+            yield word
+    if carry:
+        yield carry
+
+
+# Yield transcript entries of words_per_page words each
+def iter_pages(file, page_size=words_per_page):
     current_page = 0
-    words_per_page = 500
-
-    # Process text in chunks of 500 words
-    for i in range(0, len(words), words_per_page):
-        # Get chunk of words
-        chunk = words[i:i + words_per_page]
-        
-        # Create text entry
-        text_data_entry = {
-            'page_num': current_page,
-            'text': ' '.join(chunk)
-        }
-        text_data.append(text_data_entry)
-        current_page += 1
-
-print(json.dumps(text_data, indent=4))
-
-# Ensure temp directory exists
-temp_dir = os.path.join(PROJECT_ROOT, 'temp')
-os.makedirs(temp_dir, exist_ok=True)
-
-# Write to transcript.json
-with open(os.path.join(temp_dir, 'transcript.json'), 'w') as outfile:
-        json.dump(text_data, outfile, indent=4)
-
-print(f"Transcript saved to 'transcript.json' in {temp_dir}")
\ No newline at end of file
+    chunk = []
+    for word in iter_words(file):
+        chunk.append(word)
+        if len(chunk) == page_size:
+            yield {'page_num': current_page, 'text': ' '.join(chunk)}
+            current_page += 1
+            chunk = []
+    if chunk:
+        yield {'page_num': current_page, 'text': ' '.join(chunk)}
+
+
+# Write entries one by one, producing the same bytes as json.dump(entries, out, indent=4)
+def write_transcript(entries, outputs):
+    first = True
+    for out in outputs:
+        out.write('[')
+    for entry in entries:
+        body = json.dumps(entry, indent=4).replace('\n', '\n    ')
+        for out in outputs:
+            out.write(('\n    ' if first else ',\n    ') + body)
+        first = False
+    for out in outputs:
+        out.write(']' if first else '\n]')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split input.txt into a transcript of 500-word pages.")
+    workspace.add_argument(parser)
+    parser.add_argument('--quiet', action='store_true',
+                        help="Do not dump the transcript to stdout.")
+    args = parser.parse_args()
+
+    # Ensure the workspace exists
+    temp_dir = args.workspace
+    os.makedirs(temp_dir, exist_ok=True)
+
+    # Remove a transcript.jsonl left behind by pdf_to_text.py so it is not picked up instead
+    if os.path.exists(os.path.join(temp_dir, 'transcript.jsonl')):
+        os.remove(os.path.join(temp_dir, 'transcript.jsonl'))
+
+    # Read the input file and write pages to transcript.json as they are built
+    with open(os.path.join(temp_dir, 'input.txt'), 'r') as file, \
+            open(os.path.join(temp_dir, 'transcript.json'), 'w') as outfile:
+        outputs = [outfile] if args.quiet else [outfile, sys.stdout]
+        write_transcript(iter_pages(file), outputs)
+
+    if not args.quiet:
+        print()
+
+    print(f"Transcript saved to 'transcript.json' in {temp_dir}")
+
+
+if __name__ == '__main__':
+    main()
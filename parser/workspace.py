@@ -0,0 +1,24 @@
+import argparse
+import os
+
+# Get project root directory
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Directory for a document's input and intermediate files when none is given. Giving each
+# document its own directory lets several pipelines run at once without overwriting each other.
+default_workspace = os.getenv("PIPELINE_WORKSPACE", os.path.join(PROJECT_ROOT, 'temp'))
+
+
+# Add the --workspace option shared by the stage scripts
+def add_argument(parser):
+    parser.add_argument('--workspace', default=default_workspace,
+                        help="Directory for this document's input and intermediate files (default: temp/).")
+
+
+# Parse the command line of a stage script without other options and return its workspace, created if needed
+def parse_workspace(description):
+    parser = argparse.ArgumentParser(description=description)
+    add_argument(parser)
+    workspace = parser.parse_args().workspace
+    os.makedirs(workspace, exist_ok=True)
+    return workspace
@@ -1,14 +1,57 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS, cross_origin
 import os
+import shutil
+import time
 from dotenv import load_dotenv
 import json
-from chatbot import chatbot
+from chatbot import chatbot, stream_chatbot, ttft_summary
+from jobs import JobQueue
+from story_cache import stories, story_extensions
 
 load_dotenv()
 
 app = Flask(__name__)
 CORS(app, support_credentials=True)
+
+# Parsing runs in the background; requests only queue jobs and report on them
+job_queue = JobQueue()
+
+
+# Characters with their summaries and contexts with their summaries, as the frontend shows a story
+def story_view(story):
+    char_res = []
+    chars = story["characters"]
+    for char in chars:
+        char_res.append({
+            "name": chars[char]["name"],
+            "summary": chars[char]["summary"]
+        })
+    
+    cont_res = []
+    conts = story["contexts"]
+    for cont in conts:
+        cont_res.append({
+            "chunk_num": conts[cont]["chunk_num"],
+            "important": conts[cont]["important"],
+            "summary": conts[cont]["summary"]
+        })
+
+    return {"characters": char_res, "contexts": cont_res }
+
+
+# Response with the story view of the story file at path, built once per version of the file
+def story_view_response(path):
+    body = stories.view(path, 'story_view', lambda story: json.dumps(story_view(story)))
+    return app.response_class(body, mimetype='application/json')
+
+
+# Story name for an uploaded document, or None to let the job pick one. Path separators are
+# dropped, since the story is written to out/<name>.json.
+def story_name(name):
+    name = os.path.basename((name or "").replace("\\", "/")).strip()
+    return name if name and not name.startswith('.') else None
+
 @cross_origin(supports_credentials=True)
 
 @app.route('/api/gettext', methods=['GET'])
@@ -18,84 +61,64 @@ def gettext():
         if not text:
             return jsonify({"error": "Text parameter is required", "status": "error"}), 400
             
-        # Save text to file in root directory
-        root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        file_path = os.path.join(root_dir, 'temp/text.txt')
+        # Save the text into the job's own directory and queue it
+        job = job_queue.create('txt', story_name(request.args.get('name')))
         
         try:
-            with open(file_path, 'w') as f:
+            with open(job.input_path, 'w') as f:
                 f.write(text)
         except IOError as e:
+            job_queue.discard(job)
             return jsonify({"error": f"Failed to save text: {str(e)}", "status": "error"}), 500
-            
-        data = {
-            "message": "Text saved successfully",
-            "status": "success",
-            "data": {
-                "input_text": text,
-                "saved_to": file_path
-            }
-        }
-
-        os.system("cd " + root_dir + " && ./parser/run-txt.sh")
-
-        f = open(root_dir + "/temp/characters.json")
-        first = f.read()
-
-        return first
-        return jsonify(data), 200
+
+        job_queue.start(job)
+        return jsonify(job.to_dict()), 202
     except Exception as e:
         return jsonify({"error": str(e), "status": "error"}), 500
 
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
-    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
     file = request.files['file']
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
     
-    filename = "/out/" + file.filename.replace(".pdf", ".json")
-
-    file.save(root_dir + "/temp/input.pdf")
-
-    output =  "~" + str(os.system('cd ' + root_dir + '/parser && ./run-pdf.sh'))
-
-    print(f"Command executed with return code: {output}")   
-    
-    os.rename(root_dir + "/out/output.json", root_dir + filename) 
-    
-    f = open(root_dir + filename)
-    first = json.load(f)
-    
-    char_res = []
-    chars = first["characters"]
-    for char in chars:
-        char_res.append({
-            "name": chars[char]["name"],
-            "summary": chars[char]["summary"]
-        })
-    
-    cont_res = []
-    conts = first["contexts"]
-    for cont in conts:
-        cont_res.append({
-            "chunk_num": conts[cont]["chunk_num"],
-            "important": conts[cont]["important"],
-            "summary": conts[cont]["summary"]
-        })
-    # print(res)
+    job = job_queue.create('pdf', story_name(file.filename.replace(".pdf", "")))
+    file.save(job.input_path)
+    job_queue.start(job)
+
+    # The story appears in out/ when the job succeeds; poll /api/jobs/<id> until then
+    return jsonify(job.to_dict()), 202
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify({"jobs": [job.to_dict() for job in job_queue.list_jobs()]})
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job", "status": "error"}), 404
+    res = job.to_dict()
+    if job.status == 'succeeded':
+        res["result"] = stories.view(job.output_path, 'story_view_dict', story_view)
+    return jsonify(res)
 
-    return {"characters": char_res, "contexts": cont_res }
-    # return jsonify({'message': 'File uploaded successfully'}), 200
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    if job_queue.get(job_id) is None:
+        return jsonify({"error": "Unknown job", "status": "error"}), 404
+    if not job_queue.cancel(job_id):
+        return jsonify({"error": "Job has already finished", "status": "error"}), 409
+    return jsonify(job_queue.get(job_id).to_dict())
 
 @app.route('/api/stories', methods=['GET'])
 def get_stories():
     root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     out_dir = os.path.join(root_dir, "out")
-    files = os.listdir(out_dir)
-    story_names = [os.path.splitext(f)[0] for f in files if f.endswith('.json')]
+    files = stories.story_files(out_dir)
+    story_names = [os.path.splitext(f)[0] for f in files]
     return jsonify({"stories": story_names})
 
 @app.route('/api/getstory', methods=['GET'])
@@ -107,36 +130,15 @@ def get_story():
             
         root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
         out_dir = os.path.join(root_dir, "out")
-        files = [f for f in os.listdir(out_dir) if f.endswith('.json')]
+        files = stories.story_files(out_dir)
         
         try:
             index = int(index)
             if index < 0 or index >= len(files):
                 return jsonify({"error": "Invalid index", "status": "error"}), 400
                 
-            filename = "/out/" + files[index]
-            f = open(root_dir + filename)
-            first = json.load(f)
-
-            char_res = []
-            chars = first["characters"]
-            for char in chars:
-                char_res.append({
-                    "name": chars[char]["name"],
-                    "summary": chars[char]["summary"]
-                })
-            
-            cont_res = []
-            conts = first["contexts"]
-            for cont in conts:
-                cont_res.append({
-                    "chunk_num": conts[cont]["chunk_num"],
-                    "important": conts[cont]["important"],
-                    "summary": conts[cont]["summary"]
-                })
-            # print(res)
-
-            return {"characters": char_res, "contexts": cont_res }
+            # Served from memory unless the file changed since it was last read
+            return story_view_response(os.path.join(out_dir, files[index]))
             # return jsonify({'message': 'File uploaded successfully'}), 200
             
         except ValueError:
@@ -157,6 +159,38 @@ def chat():
     return jsonify(res)
     # return jsonify({'message': 'File uploaded successfully'}), 200
 
+# Same as /api/chat, but the reply is sent as Server-Sent Events while it is generated:
+# "data" events carry {"token": ...}, then a "done" event carries the timings, or an
+# "error" event the error
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    # Timings count from the request's arrival, not from when the server starts streaming
+    started = time.perf_counter()
+    data = request.get_json()
+    if not data:
+        return jsonify({"error": "Invalid request data", "status": "error"}), 400
+    metrics = {}
+    tokens = stream_chatbot(data['prompt'], data["character"], int(data["page"]), data["story"], metrics, started)
+
+    def events():
+        try:
+            for token in tokens:
+                yield f"data: {json.dumps({'token': token})}\n\n"
+            yield f"event: done\ndata: {json.dumps(metrics)}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            # Also runs when the client disconnects, which closes the provider stream
+            tokens.close()
+            print(f"Streamed chat reply: {metrics}")
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/metrics/chat', methods=['GET'])
+def chat_metrics():
+    return jsonify({"time_to_first_token": ttft_summary()})
+
 @app.route('/api/delete', methods=['POST'])
 def delete_story():
     try:
@@ -167,15 +201,23 @@ def delete_story():
         index = data['index']
         root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
         out_dir = os.path.join(root_dir, "out")
-        files = [f for f in os.listdir(out_dir) if f.endswith('.json')]
+        files = stories.story_files(out_dir)
         
         try:
             index = int(index)
             if index < 0 or index >= len(files):
                 return jsonify({"error": "Invalid index", "status": "error"}), 400
                 
-            file_to_delete = os.path.join(out_dir, files[index])
-            os.remove(file_to_delete)
+            # Remove the story in every format, so it does not reappear from the other file
+            name = os.path.splitext(files[index])[0]
+            for extension in story_extensions:
+                file_to_delete = os.path.join(out_dir, name + extension)
+                if os.path.exists(file_to_delete):
+                    os.remove(file_to_delete)
+            # and its context index
+            index_dir = os.path.join(out_dir, name + '.index')
+            if os.path.isdir(index_dir):
+                shutil.rmtree(index_dir)
             
             return jsonify({"message": "File deleted successfully", "status": "success"}), 200
             
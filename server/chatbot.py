@@ -2,9 +2,20 @@ import json
 from openai import OpenAI
 from dotenv import load_dotenv
 import os
+import sys
 import time
+from bisect import bisect_right
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+# Share the parser's LLM response cache
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'parser'))
+from llm_cache import cached_chat_completion, discard_cached_completion
+from story_cache import stories, story_path
+from character_timeline import personality_prompt, sentiment_prompt, sentiment_window_pages, timeline_entry
+import context_index
+
 load_dotenv()
 
 client = OpenAI(    
@@ -12,24 +23,29 @@ client = OpenAI(
     base_url="https://api.deepseek.com"
 )
 
+# Configuration parameters
+context_mode = os.getenv("CHAT_CONTEXT_MODE", "all")  # 'all' prior contexts, or 'retrieval' of those relevant to the question
+retrieval_top_k = int(os.getenv("CHAT_RETRIEVAL_TOP_K", 8))  # Most contexts retrieved per question
+retrieval_token_budget = int(os.getenv("CHAT_RETRIEVAL_TOKEN_BUDGET", 4000))  # Most context tokens retrieved per question
+
 # Function to process each chunk
 def prompt_ai(prompt):
+    request = dict(
+        model="deepseek-chat",  # llama-3.1-8b-instant
+        messages=[{"role": "user", "content": prompt}],
+        temperature=1,
+        max_completion_tokens=1024,
+        top_p=1,
+        stream=False,
+        response_format={"type": "json_object"},  # Corrected response format
+        stop=None,
+    )
+
     retries = 3
     for attempt in range(retries):
         try:
-            # Send request to Groq API
-            completion = client.chat.completions.create(
-                model="deepseek-chat",  # llama-3.1-8b-instant
-                messages=[{"role": "user", "content": prompt}],
-                temperature=1,
-                max_completion_tokens=1024,
-                top_p=1,
-                stream=False,
-                response_format={"type": "json_object"},  # Corrected response format
-                stop=None,
-            )
-            # Extract the generated text from the response
-            generated_text = completion.choices[0].message.content
+            # Send request to Groq API. The analysis is sampled, so it is asked for every time.
+            generated_text = cached_chat_completion(client, request)
 
             # Find the JSON list within the response
             start = generated_text.find('[')
@@ -47,6 +63,8 @@ def prompt_ai(prompt):
                     print(f"JSON decode error for response {json_err}")
             else:
                 print(f"No JSON list found in response for response")
+            # Do not keep serving a response that could not be used
+            discard_cached_completion(request)
             break  # Break out of the retry loop if successful
         except Exception as err:
             print(f"An error occurred for response, attempt {attempt + 1}/{retries}: {err}")
@@ -57,41 +75,98 @@ def prompt_ai(prompt):
     return None  # Return None if all attempts fail
 
 
-def process_question(question, char, page, story="", result={}):
+# Build, for every character name, the keys of the contexts they appear in sorted by last
+# page, with the last pages alongside for binary search, and the character's record (the
+# first with that name, or None). The sort is stable, so contexts ending on the same page
+# stay in story order.
+def build_character_index(result):
+    contexts_by_char = {}
+    for key, context in result["contexts"].items():
+        for char in dict.fromkeys(context["characters"]):
+            contexts_by_char.setdefault(char, []).append((context["page_nums"][-1], key))
+
+    characters = {}
+    for character in result["characters"].values():
+        characters.setdefault(character["name"], character)
+
+    index = {}
+    for char in contexts_by_char.keys() | characters.keys():
+        entries = sorted(contexts_by_char.get(char, []), key=lambda entry: entry[0])
+        index[char] = ([last_page for last_page, _ in entries], [key for _, key in entries], characters.get(char))
+    return index
+
+
+# Analysis from a precomputed timeline entry, in the form prompt_ai would have returned it,
+# or None if its request failed
+def precomputed_analysis(entry, field):
+    if entry is None or entry["context_count"] == 0:
+        return []  # No contexts, so no analysis was asked for
+    return {"response": entry[field]} if entry[field] is not None else None
 
-    sentim_contexts = []
-    all_context = []
-    prev_pages = page - 10
 
-    for key in result["contexts"]:
-        if char in result["contexts"][key]["characters"]:
-            if result["contexts"][key]["page_nums"][-1] <= page and result["contexts"][key]["page_nums"][-1] > prev_pages:
-                sentim_contexts.append(result["contexts"][key]["text"])
-            if result["contexts"][key]["page_nums"][-1] <= page:
-                all_context.append(result["contexts"][key]["text"])
+# Build the prompt for the in-character reply, from the character's personality and recent sentiments.
+# With a context index (retrieval mode), the personality is drawn from the prior contexts most
+# relevant to the question instead of from all of them.
+def reply_prompt(question, char, page, story="", result={}, index=None, contexts=None):
+    if index is None:
+        index = build_character_index(result)
+
+    prev_pages = page - sentiment_window_pages
+    last_pages, keys, character = index.get(char, ([], [], None))
+
+    # Contexts ending within the last 10 pages, and all contexts ending by the current page
+    end = bisect_right(last_pages, page)
+    start = bisect_right(last_pages, prev_pages, 0, end)
     
-    # print(sentim_contexts)
-    # print(all_context)
-    sentiments = []
-    personalities = []
-
-    if sentim_contexts:
-        p = f"What are the main sentiments of {char} with the given dialogues? {sentim_contexts}. Please put your response in list format [sentiment1, sentiment2, ...]. Ensure that the response is valid JSON and does not include any comments or explanations."
-        sentiments = prompt_ai(p)
-    if all_context:
-        p = f"What are the most important personality traits of {char} with the given dialogues? {all_context}. Please put your response in list format [trait1, trait2, ...]. Ensure that the response is valid JSON and does not include any comments or explanations."
-        personalities = prompt_ai(p)
+    sentiments = None
+    personalities = None
+    pending = {}  # Analyses to ask for now, by name
+
+    # Use the timelines the pipeline precomputed when the story has them. Analyses they lack,
+    # or whose request failed when they were built, are asked for now.
+    if character is not None and "sentiment_timeline" in character:
+        sentiments = precomputed_analysis(timeline_entry(character["sentiment_timeline"], page), "sentiments")
+    if sentiments is None:
+        sentiments = []
+        if end > start:
+            sentim_contexts = [result["contexts"][key]["text"] for key in keys[start:end]]
+            pending["sentiments"] = sentiment_prompt(char, sentim_contexts)
+    # Retrieval depends on the question, so it never uses the precomputed personality
+    if contexts is None and character is not None and "personality_timeline" in character:
+        personalities = precomputed_analysis(timeline_entry(character["personality_timeline"], page), "traits")
+    if personalities is None:
+        personalities = []
+        if contexts is not None and end > 0:
+            retrieved = context_index.select_contexts(contexts, result, f"{char}: {question}", keys[:end],
+                                                      retrieval_top_k, retrieval_token_budget)
+            pending["personalities"] = personality_prompt(char, [result["contexts"][key]["text"] for key in retrieved])
+        elif end > 0:
+            all_context = [result["contexts"][key]["text"] for key in keys[:end]]
+            pending["personalities"] = personality_prompt(char, all_context)
+
+    # Analyses that were not precomputed are asked for concurrently
+    if pending:
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            futures = {name: executor.submit(prompt_ai, p) for name, p in pending.items()}
+        if "sentiments" in futures:
+            sentiments = futures["sentiments"].result()
+        if "personalities" in futures:
+            personalities = futures["personalities"].result()
 
     # print(sentiments)
     # print(personalities)
 
     # Craft the prompt to ensure no comments in the JSON response
-    prompt = (
+    return (
         f"You are now {char} in the story {story}. Based off of {char}'s personalities: {personalities} and recent sentiments: {sentiments}"
         f"what would {char} say in response to the following question: {question}"
         f"Ensure that the response is a string and that you don't have any knowledge of anything outside of this book."
     )
 
+
+def process_question(question, char, page, story="", result={}, index=None, contexts=None):
+    prompt = reply_prompt(question, char, page, story, result, index, contexts)
+
     retries = 3
     for attempt in range(retries):
         try:
@@ -134,13 +209,75 @@ def process_question(question, char, page, story="", result={}):
                 print(f"Failed after {retries} attempts. Moving on to the next chunk.")
     return None  # Return None if all attempts fail
 
+# Load a story with its character index and, in retrieval mode, its context index. Both are
+# built once and kept in memory while the story file is unchanged.
+def load_story(story):
+    path = story_path(story)
+    result = stories.story(path)
+    index = stories.view(path, 'character_index', build_character_index)
+    contexts = None
+    if context_mode == 'retrieval':
+        contexts = stories.view(path, 'context_index',
+                                lambda story: context_index.open_context_index(story, context_index.index_dir(path)))
+    return result, index, contexts
+
+
 def chatbot(question, char, page, story=""):
     # cumulative_characters = []
 
-    # Load chunks data
-    with open(f'../out/{story}.json', 'r') as infile:
-        result = json.load(infile)
-    return process_question(question, char, page, story, result)
+    result, index, contexts = load_story(story)
+    return process_question(question, char, page, story, result, index, contexts)
+
+
+# Recent time-to-first-token measurements of streamed replies, in seconds
+ttft_samples = deque(maxlen=1000)
+
+
+# Stream the in-character reply, yielding text as the provider generates it. Timings in seconds
+# since started (a time.perf_counter() value, by default the first request for a token) are
+# stored in metrics. Pass the request's arrival time, since a generator's body only runs once
+# it is iterated. Closing the generator early (e.g. when the client disconnects) closes the
+# provider stream, which stops the generation.
+def stream_chatbot(question, char, page, story="", metrics=None, started=None):
+    metrics = {} if metrics is None else metrics
+    started = time.perf_counter() if started is None else started
+
+    result, index, contexts = load_story(story)
+    prompt = reply_prompt(question, char, page, story, result, index, contexts)
+    metrics["prompt_time"] = time.perf_counter() - started
+
+    stream = client.chat.completions.create(
+        model="deepseek-chat",
+        messages=[{"role": "user", "content": prompt}],
+        temperature=1,
+        max_completion_tokens=1024,
+        top_p=1,
+        stream=True,
+        stop=None,
+    )
+    try:
+        for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            if "time_to_first_token" not in metrics:
+                metrics["time_to_first_token"] = time.perf_counter() - started
+                ttft_samples.append(metrics["time_to_first_token"])
+            yield chunk.choices[0].delta.content
+    finally:
+        stream.close()
+        metrics["total_time"] = time.perf_counter() - started
+
+
+# Count, median and 95th percentile of the recent time-to-first-token measurements
+def ttft_summary():
+    samples = sorted(ttft_samples)
+    if not samples:
+        return {"count": 0, "p50": None, "p95": None}
+    return {
+        "count": len(samples),
+        "p50": samples[len(samples) // 2],
+        "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+    }
 
 # For Testing Purposes Only
 # while True:
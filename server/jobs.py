@@ -0,0 +1,215 @@
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Get project root directory
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Configuration parameters
+jobs_dir = os.path.join(PROJECT_ROOT, 'temp', 'jobs')  # One workspace per job for its input and intermediate files
+out_dir = os.path.join(PROJECT_ROOT, 'out')  # Finished stories are written here as <story>.json or <story>.story
+story_format = os.getenv("STORY_FORMAT", "json")  # 'json' or 'story' (SQLite, see parser/story_store.py)
+max_workers = int(os.getenv("PIPELINE_WORKERS", 2))  # Pipelines run at the same time; the rest wait in the queue
+job_timeout = int(os.getenv("PIPELINE_TIMEOUT_SECONDS", 3600))  # Running jobs are stopped after this long
+max_finished_jobs = 100  # Finished jobs kept for status queries
+log_lines = 50  # Last pipeline output lines kept per job, returned when a job fails
+fused_analysis = os.getenv("PIPELINE_FUSED", "") != ""  # Run pipeline.py with --fused (one request per chunk for summary and characters)
+build_context_index = os.getenv("CHAT_CONTEXT_MODE", "all") == 'retrieval'  # Embed contexts only when the chatbot retrieves them
+
+# Stages pipeline.py reports, in order
+pipeline_stages = (['transcript'] + (['chunk analysis'] if fused_analysis else ['chunks', 'characters'])
+                   + ['character names', 'events', 'merge', 'results', 'refine', 'character summaries',
+                      'character timelines'] + (['context index'] if build_context_index else []))
+stage_pattern = re.compile(r"^Stage '(.+)' (started|finished in .*|loaded from cache)\.$")
+
+
+# One pipeline run. Status goes queued -> running -> succeeded, failed or cancelled. With
+# unique set, the job id is appended to the story name so its output files are its own.
+class Job:
+    def __init__(self, source, story=None, unique=False):
+        self.id = uuid.uuid4().hex
+        self.source = source
+        self.story = story or f"{source}-{self.id[:8]}"
+        if unique:
+            self.story = f"{self.story}-{self.id[:8]}"
+        self.directory = os.path.join(jobs_dir, self.id)
+        self.input_path = os.path.join(self.directory, 'input.pdf' if source == 'pdf' else 'input.txt')
+        self.output_path = os.path.join(out_dir, self.story + ('.story' if story_format == 'story' else '.json'))
+        self.status = 'queued'
+        self.stage = None  # Stage currently running
+        self.completed_stages = []
+        self.error = None
+        self.log = deque(maxlen=log_lines)
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.process = None
+        self.future = None
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "completed_stages": list(self.completed_stages),
+            "progress": 1.0 if self.status == 'succeeded' else len(self.completed_stages) / len(pipeline_stages),
+            "story": self.story,
+            "error": self.error,
+            "log": list(self.log) if self.status == 'failed' else [],
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+# Helper function to send a signal to a pipeline process and every process it started
+def stop_process(process, sig):
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass  # Already exited
+
+
+# Runs pipeline.py for submitted documents on a bounded pool of worker threads, one
+# subprocess per job, so a job can report its stage as it goes and be stopped at any time
+class JobQueue:
+    def __init__(self, workers=max_workers, timeout=job_timeout):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pipeline-job")
+        self.timeout = timeout
+        self.jobs = OrderedDict()
+        self.created = {}  # Jobs created but not started yet, by id
+        self.lock = threading.Lock()
+
+    # Create a job for a 'pdf' or 'txt' document whose result goes to out/<story>.json or .story. The
+    # caller saves the document to job.input_path, then passes the job to start(). A story name
+    # already used by an unfinished job gets the new job's id appended, so two pipelines never
+    # write the same files.
+    def create(self, source, story=None):
+        with self.lock:
+            busy = {
+                other.story for other in [*self.jobs.values(), *self.created.values()]
+                if other.status in ('queued', 'running')
+            }
+            job = Job(source, story, unique=story is not None and story in busy)
+            self.created[job.id] = job
+        os.makedirs(job.directory, exist_ok=True)
+        return job
+
+    # Drop a created job that will not be started, e.g. because its document could not be saved
+    def discard(self, job):
+        with self.lock:
+            self.created.pop(job.id, None)
+        shutil.rmtree(job.directory, ignore_errors=True)
+
+    # Queue a created job. Returns right away.
+    def start(self, job):
+        with self.lock:
+            self.created.pop(job.id, None)
+            self.jobs[job.id] = job
+            self._prune()
+        job.future = self.executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    # Cancel a queued or running job. Returns False if it had already finished.
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status not in ('queued', 'running'):
+                return False
+            job.status = 'cancelled'
+            job.finished = time.time()
+            # Only succeeds while the job is still queued, in which case it never runs
+            if job.future is not None and job.future.cancel():
+                shutil.rmtree(job.directory, ignore_errors=True)
+            if job.process is not None:
+                stop_process(job.process, signal.SIGTERM)
+        return True
+
+    # Helper function to drop the oldest finished jobs beyond max_finished_jobs. Call with the lock held.
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status not in ('queued', 'running')]
+        for job_id in finished[:max(0, len(finished) - max_finished_jobs)]:
+            del self.jobs[job_id]
+
+    # Helper function to run a job's pipeline and follow its progress
+    def _run(self, job):
+        command = [
+            sys.executable, 'pipeline.py', '--source', job.source, '--input', job.input_path,
+            '--workspace', job.directory, '--output', job.output_path, '--workers', '0',
+        ] + (['--fused'] if fused_analysis else []) + (['--context-index'] if build_context_index else [])
+        with self.lock:
+            if job.status != 'queued':
+                return
+            job.status = 'running'
+            job.started = time.time()
+            try:
+                # A session of its own, so stopping the job also stops its PDF extraction workers
+                job.process = subprocess.Popen(
+                    command, cwd=os.path.join(PROJECT_ROOT, 'parser'), stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT, text=True, env={**os.environ, "PYTHONUNBUFFERED": "1"},
+                    start_new_session=True,
+                )
+            except OSError as err:
+                job.status = 'failed'
+                job.error = f"Could not start the pipeline: {err}"
+                job.finished = time.time()
+                shutil.rmtree(job.directory, ignore_errors=True)
+                return
+
+        timed_out = threading.Event()
+
+        def stop():
+            timed_out.set()
+            stop_process(job.process, signal.SIGKILL)
+
+        timer = threading.Timer(self.timeout, stop)
+        timer.daemon = True
+        timer.start()
+        try:
+            for line in job.process.stdout:
+                line = line.rstrip()
+                job.log.append(line)
+                match = stage_pattern.match(line)
+                if match is None:
+                    continue
+                name, event = match.groups()
+                with self.lock:
+                    if event == 'started':
+                        job.stage = name
+                    elif name not in job.completed_stages:
+                        job.completed_stages.append(name)
+                        job.stage = None
+            returncode = job.process.wait()
+        finally:
+            timer.cancel()
+            shutil.rmtree(job.directory, ignore_errors=True)
+
+        with self.lock:
+            job.stage = None
+            if job.status == 'cancelled':
+                return
+            job.finished = time.time()
+            if timed_out.is_set():
+                job.status = 'failed'
+                job.error = f"Timed out after {self.timeout} seconds."
+            elif returncode != 0:
+                job.status = 'failed'
+                job.error = f"Pipeline exited with code {returncode}."
+            else:
+                job.status = 'succeeded'
@@ -0,0 +1,123 @@
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+# Get project root directory
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if os.path.join(PROJECT_ROOT, 'parser') not in sys.path:
+    sys.path.insert(0, os.path.join(PROJECT_ROOT, 'parser'))
+import story_store
+
+# Configuration parameters
+out_dir = os.path.join(PROJECT_ROOT, 'out')  # Where finished stories are stored
+story_extensions = (story_store.story_extension, '.json')  # Story file formats, preferred first
+max_cache_bytes = int(os.getenv("STORY_CACHE_MAX_BYTES", 512 << 20))  # Memory cap before least recently used stories are dropped
+memory_per_file_byte = 4  # Rough memory taken by a parsed story per byte of its JSON file
+
+
+# A parsed story and the API views computed from it. store is the StoryStore of a .story
+# file, whose file handle is closed when the story leaves the cache.
+class CachedStory:
+    def __init__(self, story, mtime_ns, size, store=None):
+        self.story = story
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.store = store
+        self.views = {}
+        self.lock = threading.Lock()
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+
+    # Return func(story), computing it only the first time it is asked for under name
+    def view(self, name, func):
+        with self.lock:
+            if name not in self.views:
+                self.views[name] = func(self.story)
+            return self.views[name]
+
+
+# Parsed stories kept in memory, least recently used first out once their estimated
+# size passes max_bytes. A story is re-read when its file's mtime or size changes.
+class StoryCache:
+    def __init__(self, max_bytes=max_cache_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total = 0
+        self.listing = None  # (directory, mtime_ns, story files) of the last listing
+        self.lock = threading.Lock()
+
+    # Return the CachedStory for the JSON file at path. Raises FileNotFoundError if it does not exist.
+    def get(self, path):
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+                self.entries.move_to_end(path)
+                return entry
+
+        # Parse outside the lock, so other stories stay available meanwhile. Context texts
+        # of .story files are only read when used.
+        if path.endswith(story_store.story_extension):
+            story, store = story_store.open_story(path)
+            entry = CachedStory(story, stat.st_mtime_ns, stat.st_size, store)
+        else:
+            with open(path, 'r') as infile:
+                entry = CachedStory(json.load(infile), stat.st_mtime_ns, stat.st_size)
+
+        with self.lock:
+            self._remove(path)
+            self.entries[path] = entry
+            self.total += entry.size * memory_per_file_byte
+            while self.total > self.max_bytes and len(self.entries) > 1:
+                self._remove(next(iter(self.entries)))
+        return entry
+
+    # Return the parsed story at path
+    def story(self, path):
+        return self.get(path).story
+
+    # Return func(story) for the story at path, cached with the story under name
+    def view(self, path, name, func):
+        return self.get(path).view(name, func)
+
+    # Names of the story files in directory, in os.listdir order, re-listed only when the directory
+    # changes. A story stored in both formats is listed once, by its .story file.
+    def story_files(self, directory=out_dir):
+        mtime_ns = os.stat(directory).st_mtime_ns
+        with self.lock:
+            if self.listing is not None and self.listing[:2] == (directory, mtime_ns):
+                return self.listing[2]
+        names = os.listdir(directory)
+        present = set(names)
+        files = [
+            f for f in names
+            if f.endswith(story_store.story_extension)
+            or f.endswith('.json') and os.path.splitext(f)[0] + story_store.story_extension not in present
+        ]
+        with self.lock:
+            self.listing = (directory, mtime_ns, files)
+        return files
+
+    # Helper function to drop a story, closing its file. Call with the lock held.
+    def _remove(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.total -= entry.size * memory_per_file_byte
+            entry.close()
+
+
+# Process-wide cache shared by the API routes and the chatbot
+stories = StoryCache()
+
+
+# Path of a story's file given its name, preferring the .story format
+def story_path(name):
+    for extension in story_extensions:
+        path = os.path.join(out_dir, name + extension)
+        if os.path.exists(path):
+            return path
+    return os.path.join(out_dir, name + '.json')